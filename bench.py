@@ -0,0 +1,256 @@
+# bench.py
+
+
+# This file times each stage of the pipeline in osc.py and osccore.py
+# on synthetic decays, so that runs can be compared over time. It
+# needs no oscilloscope or display: transfers are replayed from
+# memory and drawing goes to a canvas that only counts its items.
+# > python bench.py [--sizes 10000,100000] [--out results.json]
+# Each trace size and decay kind gets the best time of each stage,
+# the most memory it took and the peak memory of the process while it
+# ran, and the fitted lifetimes next to the ones the trace was made
+# with. Each decay kind gets how far autoWindow's window moves between
+# sizes.
+
+
+import numpy as np
+import sys
+import time
+import json
+import gc
+import resource
+import shutil
+import tempfile
+import platform
+from osccore import *
+from osc import Graph
+
+
+################################
+######## STAND-INS #############
+################################
+
+# This class replays a recorded curve transfer, in place of an
+# instrument, for the read functions.
+class Transfer(object):
+
+    def __init__(self,raw):
+        self.raw = raw
+        self.at = 0
+
+    def read_raw(self,num=-1):
+        if num < 0: num = len(self.raw)-self.at
+        raw = self.raw[self.at:self.at+num]
+        self.at += len(raw)
+        return raw
+
+# This class stands in for a tkinter canvas, counting the items drawn
+# on it.
+class HeadlessCanvas(object):
+
+    def __init__(self):
+        self.items = 0
+
+    def create(self,*args,**options):
+        self.items += 1
+        return self.items
+
+    create_line = create_oval = create_rectangle = create_text = create
+
+
+################################
+####### SYNTHETIC DECAYS #######
+################################
+
+# the decays - lifetimes (s) and amplitudes (V) of their terms
+DECAYS = {"mono":([2e-6],[1.0]), "bi":([1e-6,5e-6],[0.7,0.3])}
+SPAN = 20e-6 # record length (s), whatever the number of samples
+RISE = 0.2e-6 # time to the peak (s)
+NOISE = 0.002 # noise deviation (V)
+YMULT = 2/30000.0 # volts per curve value, about 1 V at 15000
+
+# This function makes the limits and 16-bit curve values of a decay
+# with the given number of samples, in the order the scope sends them.
+def decay(samples, kind, seed=0):
+    lifetimes,amplitudes = DECAYS[kind]
+    xincr = SPAN/samples
+    ts = np.arange(samples)*xincr
+    ys = np.zeros(samples)
+    for (lifetime,amplitude) in zip(lifetimes,amplitudes):
+        ys += amplitude*np.exp(-np.maximum(ts-RISE,0)/lifetime)
+    ys *= np.minimum(ts/RISE,1)
+    ys += np.random.RandomState(seed).normal(0,NOISE,samples)
+    codes = np.round(ys/YMULT).astype(">i2")
+    limits = ["0","%r" % YMULT,"0","%r" % xincr,"0"]
+    return limits,codes
+
+# This function makes the bytes of an ASCII and a binary curve
+# transfer of the curve values.
+def transfers(codes):
+    ascii = ",".join(codes.astype(str)).encode() + b"\n"
+    payload = codes.tobytes()
+    length = str(len(payload)).encode()
+    binary = b"#" + str(len(length)).encode() + length + payload + b"\n"
+    return ascii,binary
+
+
+################################
+######### BENCHMARKING #########
+################################
+
+# This function gives the memory in use by the process and its peak,
+# in MB. On Linux the peak can be reset, see resetPeak, otherwise it is
+# the peak of the whole run so far.
+def memory():
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":",1) for line in f)
+        return (int(fields["VmRSS"].split()[0])/1024.0,
+            int(fields["VmHWM"].split()[0])/1024.0)
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+        return peak,peak
+
+# This function resets the peak memory of the process to what is in
+# use, so that the peak of each stage can be measured.
+def resetPeak():
+    try:
+        with open("/proc/self/clear_refs","w") as f: f.write("5")
+    except IOError: pass
+
+# This function has glibc map every large block afresh and unmap it
+# when freed, instead of reusing freed heap, so that the memory a stage
+# takes shows in the memory in use.
+def mapLargeBlocks():
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").mallopt(-3,128*1024) # M_MMAP_THRESHOLD
+    except (OSError, AttributeError): pass
+
+# This function times a stage, keeping the best of repeat runs, and
+# returns its result from the last run. The memory it took is the most
+# any run took above what was in use when it started.
+def timeStage(stages, name, work, repeat):
+    best = None
+    grew = 0
+    for i in range(repeat):
+        gc.collect()
+        resetPeak()
+        before = memory()[0]
+        start = time.time()
+        result = work()
+        seconds = time.time()-start
+        used,peak = memory()
+        if best == None or seconds < best: best = seconds
+        grew = max(grew,peak-before)
+    stages[name] = {"seconds":best,"peakMB":peak,"grewMB":grew}
+    return result
+
+# This function runs every stage on one decay, returning its timings
+# and fitted lifetimes.
+def benchTrace(samples, kind, repeat, fitLimit, folder):
+    limits,codes = decay(samples,kind)
+    ascii,binary = transfers(codes)
+    stages = {}
+    run = lambda name,work: timeStage(stages,name,work,repeat)
+    run("readAscii",lambda: readAscii(Transfer(ascii),samples,Progress()))
+    data = run("readBinary",lambda: readBinary(Transfer(binary),
+        "RIBINARY",2,Progress()))
+    limits = map(readLimit,limits)
+    data = run("readCurve",lambda: readCurve(limits,data))
+    points = run("buildPoints",lambda: buildPoints(limits,data))
+    xlim,ylim = run("getEdges",lambda: getEdges(points))
+    # fits from the peak to where the slowest term has fallen to e^-4
+    lifetimes,amplitudes = DECAYS[kind]
+    fit = FitJob(RISE,RISE+4*max(lifetimes))
+    graph = Graph(xlim,ylim,"Time (s)","Voltage (V)",points,
+        "Voltage vs. Time",(5,270,795,795))
+    logGraph = run("makeLogGraph",lambda: graph.makeLogGraph(fit))
+    run("linReg",lambda: linReg(fit,logGraph.points))
+    sums = run("CumulativeFit",lambda: CumulativeFit(points))
+    window = run("autoWindow",lambda: autoWindow(points,sums))
+    model = "single" if len(lifetimes) == 1 else "double"
+    fits = None
+    if samples <= fitLimit:
+        fits = run("fitTraces",lambda: fitTraces(points.ys,points.xzero,
+            points.xincr,fit.lb,fit.ub,model))
+    for format in ("txt","npz"):
+        run("saveWell." + format,lambda: saveWell(folder,"A01",0,0,fit,
+            points,logGraph.points,[format]))
+    canvas = HeadlessCanvas()
+    def draw():
+        graph.pixels = None
+        graph.drawPoints(canvas)
+    run("drawPoints",draw)
+    run("drawPoints.cached",lambda: graph.drawPoints(canvas))
+    # lifetimes in ns, against the ones the decay was made with
+    truth = [lifetime*10**9 for lifetime in lifetimes]
+    accuracy = {"truth":truth,"loglinear":fit.lifetime,
+        "loglinearError":fit.lifetime/max(truth)-1,"autoWindow":window}
+    if None not in window:
+        auto = FitJob(*window)
+        linReg(auto,logData(points,auto))
+        accuracy["autoWindowLifetime"] = auto.lifetime
+    if fits != None:
+        fitted = sorted(fits.lifetime[0].tolist())
+        accuracy[model] = fitted
+        accuracy[model + "Error"] = [found/true-1 for (found,true) in
+            zip(fitted,sorted(truth))]
+    return {"samples":samples,"kind":kind,"stages":stages,
+        "accuracy":accuracy}
+
+# This function checks that autoWindow picks the same window for each
+# decay whatever its number of samples, giving the spread of the window
+# bounds (s) and fitted lifetimes (ns) over the sizes run.
+def windowStability(runs):
+    stability = {}
+    for kind in sorted(set(run["kind"] for run in runs)):
+        found = [run["accuracy"] for run in runs if run["kind"] == kind
+            and "autoWindowLifetime" in run["accuracy"]]
+        if found == []: continue
+        windows = np.array([accuracy["autoWindow"] for accuracy in found],
+            dtype=float)
+        lifetimes = [accuracy["autoWindowLifetime"] for accuracy in found]
+        stability[kind] = {"lbSpread":np.ptp(windows[:,0]),
+            "ubSpread":np.ptp(windows[:,1]),
+            "lifetimeSpread":np.ptp(lifetimes)}
+    return stability
+
+# This function runs the benchmarks from the shell, printing or
+# saving the results as JSON.
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline on synthetic decays.")
+    parser.add_argument("--sizes",default="10000,100000,1000000,10000000",
+        help="comma-separated numbers of samples")
+    parser.add_argument("--kinds",default="mono,bi",
+        help="decays to run: mono, bi")
+    parser.add_argument("--repeat",type=int,default=3,
+        help="runs of each stage, the best being kept")
+    parser.add_argument("--fit-limit",type=int,default=1000000,
+        help="most samples to run fitTraces on")
+    parser.add_argument("--out",help="json file to save the results to")
+    args = parser.parse_args(args)
+    mapLargeBlocks()
+    folder = tempfile.mkdtemp()
+    try:
+        runs = []
+        for samples in map(int,args.sizes.split(",")):
+            for kind in args.kinds.split(","):
+                runs.append(benchTrace(samples,kind,args.repeat,
+                    args.fit_limit,folder))
+                gc.collect()
+    finally:
+        shutil.rmtree(folder)
+    results = {"time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":platform.python_version(),"numpy":np.__version__,
+        "machine":platform.platform(),"runs":runs,
+        "stability":windowStability(runs)}
+    text = json.dumps(results,indent=1,sort_keys=True)
+    if args.out == None: print(text)
+    else:
+        with open(args.out,"wt") as f: f.write(text)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,114 +3,31 @@
 # osc.py
 
 
-# Setup instructions
-
-# Make sure to install python module vxi11.
-# > sudo pip install python-vxi11
-
-# ip directions
-# > hostname -I
-# choose the ip address starting with 169
-# change the instrument ip address to this number with a different 4th field
-# i.e. pi says 169.254.5.136 -> for instrument use 169.254.5.1 etc.
-#
-# to change instrument ip address
-# utility -> system i/o -> i/o -> change instrument settings
+# Setup instructions are at the top of osccore.py.
 
 
 # This file documents a program to determine the lifetime of chemical 
 # fluorescence when paired with an oscilloscope. The pi collects data
 # from the oscilloscope and processes it to create viewable graphs.
+# The acquisition, fitting and saving are in osccore.py, and this
+# file holds the UI, which is started by running it:
+# > python osc.py
+# Given a command, it runs the osccore.py command line instead, e.g.
+# > python osc.py scan-plate <folder> --lb 1e-6 --ub 5e-6
+# Pressing s on the plot screen shows the time spent in each stage, and
+# OSC_STATS=<file> logs it for each acquisition, see Stats in osccore.py.
+# Pressing a switches New Data to averaging several shots, and w to
+# transferring only the samples around the bounds, see sampleWindow.
 
 
-import vxi11
-from Tkinter import *
-import Tkinter, Tkconstants, tkFileDialog
-import math
 import numpy as np
 import os
-
-
-##############################
-# oscilloscope interfacing
-##############################
-
-# This function gets raw data from the oscilloscope.
-def acquireData():
-    # the instrument ip depends on the pi - see ip directions at top
-    instr = vxi11.Instrument("169.254.5.1")
-    instr.clear()
-    # instrument query commands to get data limits
-    instr.write(":DATA:SOURCE CH1;:DATA:START 1.0;:DATA:STOP 10000.0;")
-    instr.write(":DATA:ENCDG ascii;:DATA:WIDTH 2;")
-    instr.write("*WAI;:WFMPRE:YOFF?;:WFMPRE:YMULT?;:WFMPRE:YZERO?;:WFMPRE:XINCR?;:WFMPRE:XZERO?")
-    limits = str(instr.read(num=1024)).split(";")
-    # instrument query command to get data points
-    instr.write("CURVE?")
-    data = ""
-    # gets all points
-    while(len(data.split(",")) < 10000):
-        data += str(instr.read(num=4096))
-    return limits, data.split(",")
-
-# This function reads the raw limit data from the oscilloscope.
-def readLimit(limit):
-    splt = limit.split("E")
-    if len(splt) > 1:
-        return float(splt[0]) * (10.0 ** float(splt[1]))
-    else:
-        return float(limit)
-
-# This function reads the raw data points and converts them using
-# the provided limits.
-def readDatum(limits):
-    yoff, ymult, yzero, xincr, xzero = limits
-    return (lambda x: round((float(x)-yoff)*ymult + yzero, 8))
-
-# This function provides the time data points.
-def buildPoints(limits, data):
-    yoff, ymult, yzero, xincr, xzero = limits
-    lst = []
-    for i in range(len(data)):
-        lst.append((round(xzero + xincr * i, 8), data[i]))
-    return lst
-
-# This function determines the min max data points.
-def getEdges(points):
-    ymin = ymax = points[0][1]
-    for (x,y) in points:
-        if y < ymin: ymin = y
-        if y > ymax: ymax = y
-    return (0,points[-1][0]),(ymin,ymax)
-
-# This function connects all interfacing functions to return
-# readable data points and limits.
-def getData():
-    limits, data = acquireData()
-    limits = map(readLimit, limits)
-    data = map(readDatum(limits), data)
-    points = buildPoints(limits, data)
-    xlim,ylim = getEdges(points)
-    return points,xlim,ylim
-
-
-# extra functions
-
-# This function returns the log of all acceptable inputs,
-# otherwise it returns None.
-def safeLog(x):
-    if x > 0: return math.log(x)
-    else: return None
-
-# This function computes the log data point.
-def yLog(point):
-    x,y = point
-    return (x,safeLog(y))
-
-# from 15-112, This function writes contents to a file.
-def writeFile(path, contents):
-    with open(path, "wt") as f:
-        f.write(contents)
+import sys
+import threading
+import Queue
+import time
+from collections import OrderedDict
+from osccore import *
 
 
 ################################
@@ -127,7 +44,7 @@ class Graph(object):
         self.ylim = ylim # bounds on y data
         self.xaxis = xaxis # x axis label
         self.yaxis = yaxis # y axis label
-        self.points = points # data points
+        self.points = points # data points, as a Waveform
         self.title = title # graph title
         self.coord = coord # tkinter graph space edges
         self.margin = 20
@@ -149,6 +66,7 @@ class Graph(object):
         self.xscale = (x2-x1)/float(UB-LB)
         LB,UB = self.ylim
         self.yscale = (y2-y1)/float(UB-LB)
+        self.pixels = None # point coordinates, found when drawn
 
     # This function converts a data point to a coordinate space
     # point.
@@ -166,10 +84,6 @@ class Graph(object):
         ycoord = self.ylim[1]-(y-self.axisLimits[1])/self.yscale
         return xcoord,ycoord
 
-    # This function adds a new point to the data points.
-    def addPoint(self,point):
-        self.points.append(point)
-
     # This function updates the x and y limits of the data,
     # changing the scaling factor.
     def updateLimits(self,xlim,ylim):
@@ -179,7 +93,7 @@ class Graph(object):
 
     # This function determines if a graph is empty.
     def isEmpty(self):
-        return self.points == []
+        return len(self.points) == 0
 
     # This function checks if a coordinate point is within 
     # the graph sapce.
@@ -189,30 +103,13 @@ class Graph(object):
 
     # This function makes a log graph from a linear graph.
     def makeLogGraph(self, data):
-        # This function checks if a point is within bounds.
-        def inBound(point):
-            x,y = point
-            # if the bound isn't set, all points are in
-            if data.bound[0] != None:
-                if data.lb > x: return False
-            if data.bound[1] != None:
-                if data.ub < x: return False
-            return True
-        # This function gets the correct value out of a tuple.
-        def getTuple(point,idx):
-            return point[idx]
-        # This function checks if a value is None.
-        def notNone(point):
-            x,y = point
-            return y != None
         # gets the points in the log graph
-        points = filter(notNone, map(yLog, filter(inBound,self.points)))
-        ys = map(lambda x: getTuple(x,1), points)
-        xs = map(lambda x: getTuple(x,0), points)
-        ylow,xlow = min(ys),min(xs)
-        yup,xup = max(ys),max(xs)
+        points = logData(self.points,data)
+        xs = points.xs() # sorted in time
+        ylow,xlow = points.ys.min(),xs[0]
+        yup,xup = points.ys.max(),xs[-1]
         # finds the lifetime of the data
-        linReg(data,xs,ys)
+        linReg(data,points)
         return Graph((xlow,xup),(ylow,yup),self.xaxis,self.yaxis,points,
             self.title,self.coord)
 
@@ -248,15 +145,39 @@ class Graph(object):
             canvas.create_line(x1,y1,x2,y2)
             canvas.create_text(x2,y2+20,anchor="n",text=str(val),angle=90)
 
-    # This function draws the points on the graph.
+    # This function draws the points on the graph. When there are
+    # more points than pixel columns, their envelope is drawn as a
+    # single line instead of a marker per point.
     def drawPoints(self,canvas):
-        for point in self.points:
-            x,y = self.getCoord(point)
-            if y == None: continue
+        # the coordinates only change with the data or limits
+        if self.pixels == None:
+            xs,ys = self.getCoord((self.points.xs(),self.points.ys))
+            if len(xs) > self.axisLimits[2]-self.axisLimits[0]:
+                self.pixels = ("line",self.envelope(xs,ys).tolist())
+            else: self.pixels = ("oval",zip(xs.tolist(),ys.tolist()))
+        kind,pixels = self.pixels
+        if kind == "line":
+            canvas.create_line(pixels,fill="black")
+            return
+        for (x,y) in pixels:
             x1,y1 = x-2,y-2
             x2,y2 = x+2,y+2
             canvas.create_oval(x1,y1,x2,y2,fill="black")
 
+    # This function reduces coordinate points, sorted by x, to the min
+    # and max y of each pixel column they fall in, returning the flat
+    # x,y coordinates of a line through them.
+    def envelope(self,xs,ys):
+        columns = np.floor(xs).astype(int)
+        # the first point of each column
+        starts = np.flatnonzero(np.diff(columns))+1
+        starts = np.concatenate(([0],starts))
+        coords = np.empty((len(starts),4))
+        coords[:,0] = coords[:,2] = columns[starts]
+        coords[:,1] = np.minimum.reduceat(ys,starts)
+        coords[:,3] = np.maximum.reduceat(ys,starts)
+        return coords.ravel()
+
     # This function draws the graph labels.
     def drawLabels(self,canvas):
         x1,y1,x2,y2 = self.coord
@@ -268,37 +189,78 @@ class Graph(object):
             font = "Arial 12 bold",angle=90)
 
 
+####################################
+# log graph cache #
+####################################
+
+# the most memory the cached log graphs can hold, in bytes - set with
+# the OSC_CACHE_BYTES environment variable
+CACHE_BYTES = int(os.environ.get("OSC_CACHE_BYTES", 64*2**20))
+
+# This class keeps the log graphs and fits made from earlier bound
+# choices, keyed by (acquisition, lb, ub, model), so that switching
+# views or going back to earlier bounds does not refit. The least
+# recently used are dropped once they hold more than limit bytes.
+class LogCache(object):
+
+    def __init__(self,limit=CACHE_BYTES):
+        self.limit = limit
+        self.entries = OrderedDict() # key -> (graph,fit,size)
+        self.size = 0 # bytes held
+        self.hits = 0
+        self.misses = 0
+
+    # This function gets the graph and fit for a key, or None.
+    def get(self,key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        graph,fit,size = self.entries.pop(key)
+        self.entries[key] = (graph,fit,size) # now most recently used
+        return graph,fit
+
+    # This function adds a graph and fit, dropping old ones as needed.
+    def put(self,key,graph,fit):
+        if key in self.entries: self.size -= self.entries.pop(key)[2]
+        points = graph.points
+        size = points.ys.nbytes
+        if points.index is not None: size += points.index.nbytes
+        if size > self.limit: return
+        self.entries[key] = (graph,fit,size)
+        self.size += size
+        while self.size > self.limit:
+            self.size -= self.entries.popitem(last=False)[1][2]
+
+# This function gives the cache key of the log graph for the current
+# acquisition and bounds.
+def logKey(data):
+    lb = data.lb if data.bound[0] != None else None
+    ub = data.ub if data.bound[1] != None else None
+    return (data.acquisition,lb,ub,"loglinear")
+
+
 ####################################
 # UI
 ####################################
 
-# This function determines the lifetime and r2 value for
-# the log graph.
-def linReg(data,x1,y1):
-    # converts data to solver format
-    x = np.array(x1)
-    y = np.array(y1)
-    n = np.size(x)
-    # calculates slope
-    m_x,m_y = np.mean(x),np.mean(y)
-    SS_xy = np.sum(y*x) - n*m_y*m_x
-    SS_xx = np.sum(x*x) - n*m_x*m_x
-    b_1 = SS_xy / SS_xx
-    b_0 = m_y - b_1*m_x
-    data.yint = b_0
-    data.slope = b_1
-    # calculates r2
-    yhat = np.array(map(lambda x: b_1*x+b_0,x1))
-    SSR = np.sum((yhat-m_y)**2)
-    SSTO = np.sum((y-m_y)**2)
-    data.r2 = SSR/SSTO
-    data.lifetime = -(10**9)/b_1
+# the shots averaged for each acquisition in averaging mode, the
+# signal to noise ratio that stops it early and the shots taken per
+# FastFrame transfer - set with the OSC_SHOTS, OSC_SNR and OSC_FRAMES
+# environment variables, OSC_SNR=0 for no early stop
+AVERAGE_SHOTS = int(os.environ.get("OSC_SHOTS", 16))
+AVERAGE_SNR = float(os.environ.get("OSC_SNR", 0)) or None
+AVERAGE_FRAMES = int(os.environ.get("OSC_FRAMES", 1))
+# samples transferred each side of the bounds in windowed mode, as a
+# fraction of the window - set with OSC_MARGIN
+WINDOW_MARGIN = float(os.environ.get("OSC_MARGIN", 0.1))
 
 # This function creates an empty V vs. t graph.
 def emptyGraph(data):
     return Graph((0,0.0000001),(0,1),"Time (ns)","Voltage (V)",
-        [],"Voltage vs. Time",(data.margin,data.height/3+data.margin,
-            data.width-data.margin,data.height-data.margin))
+        Waveform(np.empty(0),0,1),"Voltage vs. Time",(data.margin,
+            data.height/3+data.margin,data.width-data.margin,
+                data.height-data.margin))
 
 # This function initializes the data that changes each time
 # that new data is requested.
@@ -314,17 +276,8 @@ def plotInit(data):
     data.r2 = 0
     data.selected = (None,None)
     data.highlight = (None,None)
-
-# This function creates a 96 well grid of white space 
-# iteratively to avoid aliasing.
-def initGrid():
-    grid = []
-    for j in range(8):
-        row = []
-        for i in range(12):
-            row.append("white")
-        grid.append(row)
-    return grid
+    data.sums = None # for fits while bounds are dragged
+    data.drag = None # bound being dragged
 
 # This function is the program initialization.
 def init(data):
@@ -337,6 +290,17 @@ def init(data):
     data.lb = 0
     data.ub = 0
     data.bound = [None,None]
+    data.scope = Scope()
+    data.formats = SAVE_FORMATS
+    data.acquisition = 0 # counts the acquisitions, for the cache
+    data.showStats = False # whether the stats overlay is shown
+    data.average = False # whether acquisitions are averaged
+    data.windowed = False # whether only the bounds are transferred
+    data.logCache = LogCache()
+    # for background jobs
+    data.job = None
+    data.results = Queue.Queue()
+    data.status = ""
     # for save mode
     data.color = initGrid()
     data.colName = map(str,range(1,13))
@@ -344,35 +308,125 @@ def init(data):
     data.header = ["NN","CN"]
     data.last = (None,None)
 
-# This function binary searches for an x coordinate in
-# a list of tuples, returning the y coordinate.
-def search(lst, elem):
-    # base cases
-    if len(lst) == 0: return None
-    elif len(lst) == 1:
-        x,y = lst[0]
-        if x == elem: return y
-    # recursive case
-    else: # check midpoint
-        x,y = lst[len(lst)//2]
-        if x == elem: return y
-        elif x < elem: return search(lst[len(lst)//2+1:],elem)
-        elif x > elem: return search(lst[:len(lst)//2-1],elem)
+# This function runs work(progress) on a worker thread, one job at a
+# time. Once it finishes, pollJob hands the result to done(data,result)
+# on the main thread.
+def startJob(data, status, work, done):
+    if data.job != None: return False
+    progress = data.job = Progress()
+    data.status = status
+    data.jobDone = done
+    def run():
+        try: result = (done,work(progress))
+        except Exception as error: result = (None,error)
+        data.results.put((progress,result))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return True
+
+# This function checks for a finished job, from the timer. Partial
+# results of a running job are handed to its done function as well.
+# It returns whether the view may have changed: a job is running, so
+# its progress is shown, or has finished.
+def pollJob(data):
+    if data.job != None and data.job.partial != None:
+        result,data.job.partial = data.job.partial,None
+        data.jobDone(data,result)
+    try: progress,(done,result) = data.results.get_nowait()
+    except Queue.Empty: return data.job != None
+    data.job = None
+    data.status = ""
+    if progress.cancelled: data.status = "Cancelled"
+    elif done != None: done(data,result)
+    else: data.status = "Error: " + str(result)
+    return True
+
+# This function describes the running job and how far along it is.
+def statusText(data):
+    if data.job == None: return data.status
+    elif data.job.cancelled: return "Cancelling"
+    elif data.job.total > 0:
+        return data.status + " %d%%" % (100*data.job.received//data.job.total)
+    elif data.job.received > 0:
+        return data.status + " (%d kB)" % (data.job.received//1024)
+    return data.status
+
+# This function gets new data on a worker thread.
+def newData(data):
+    plotInit(data)
+    # logs the stats of the last acquisition
+    STATS.record(acquisition=data.acquisition)
+    data.acquisition += 1
+    scope = data.scope
+    coord = (data.margin,data.height/3+data.margin,data.width-data.margin,
+        data.height-data.margin)
+    # creates a new graph with the new data
+    def graph(points,xlim,ylim):
+        return Graph(xlim,ylim,"Time (s)","Voltage (V)",points,
+            "Voltage vs. Time",coord)
+    averaged = [None,None] # shots so far and their error
+    window = None # bounds to transfer the samples of
+    if (data.windowed and None not in data.bound and data.lb < data.ub):
+        window = (data.lb,data.ub)
+    def work(progress):
+        # shows the average so far after each shot
+        def shot(average):
+            averaged[:] = [average.count,average.typicalError()]
+            progress.partial = ((graph(*average.points()),None) +
+                tuple(averaged))
+        try:
+            first,length = 1,RECORD_LENGTH
+            if window != None:
+                first,length = sampleWindow(scope,window[0],window[1],
+                    WINDOW_MARGIN)
+            if not data.average: points,xlim,ylim = getData(scope,
+                progress=progress,length=length,first=first)
+            else: points,xlim,ylim = getAverage(scope,AVERAGE_SHOTS,
+                AVERAGE_SNR,progress=progress,shot=shot,
+                frames=AVERAGE_FRAMES,length=length,first=first)
+        except Cancelled:
+            scope.close() # drops the rest of the transfer
+            raise
+        return ((graph(points,xlim,ylim),CumulativeFit(points)) +
+            tuple(averaged))
+    def done(data,result):
+        graph,sums,shots,error = result
+        data.graph = graph
+        if sums != None: data.sums = sums
+        if window != None: # the bounds move with the new x axis
+            data.bound = [graph.getCoord((t,0))[0] for t in window]
+        if shots == 1: data.status = "Averaged 1 shot"
+        elif shots != None:
+            data.status = "Averaged %d shots, error %.3g V" % (shots,error)
+    startJob(data,"Getting New Data",work,done)
+
+# This function fits the log of the data on a worker thread, showing
+# the log plot once it is done. Graphs already made for these bounds
+# are shown from the cache.
+def showLogPlot(data):
+    key = logKey(data)
+    cached = data.logCache.get(key)
+    if cached != None:
+        data.logGraph,fit = cached
+        fit.results(data)
+        data.log = True
+        return
+    graph,fit = data.graph,FitJob(data.lb,data.ub,data.bound)
+    def work(progress):
+        return graph.makeLogGraph(fit),fit
+    def done(data,result):
+        data.logGraph,fit = result
+        data.logCache.put(key,data.logGraph,fit)
+        fit.results(data)
+        data.log = True
+    startJob(data,"Showing Log Plot",work,done)
 
 # This function responds to button clicks in the left column.
 def pressLeft(canvas, data, index):
-    if index == 0: # new data button
-        # prints status to show that it's computing
-        canvas.create_text(data.width/2,20,text="Getting New Data",
-            font="Arial 20 bold")
-        plotInit(data)
-        canvas.update()
-        points,xlim,ylim = getData()
-        # creates a new graph with the new data
-        data.graph = Graph(xlim,ylim,"Time (s)","Voltage (V)",
-        points,"Voltage vs. Time",(data.margin,
-            data.height/3+data.margin,data.width-data.margin,
-                data.height-data.margin))
+    if index == 0: # new data button, or cancel while busy
+        if data.job != None: data.job.cancel()
+        else: newData(data)
     elif index ==1: # save button on log plot
         if data.log: data.mode = "save"
     elif index ==2: # set lower bound on linear plot
@@ -381,22 +435,8 @@ def pressLeft(canvas, data, index):
 # This function responds to button clicks in the right column.
 def pressRight(canvas, data, index):
     if index == 0: # switches between log and linear plot.
-        if data.log: 
-            # prints status to show that it's computing
-            canvas.create_text(data.width/2,20,text="Showing Linear Plot",
-                font="Arial 20 bold")
-            canvas.update()
-            data.log = False
-        else: 
-            # prints status to show that it's computing
-            canvas.create_text(data.width/2,20,text="Showing Log Plot",
-                font="Arial 20 bold")
-            canvas.update()
-            data.log = True
-            # only computes a new log graph when necessary
-            if (data.logGraph.isEmpty() or 
-                    (data.logGraph.xlim != (data.lb,data.ub))):
-                data.logGraph = data.graph.makeLogGraph(data)
+        if data.log: data.log = False
+        elif not data.graph.isEmpty(): showLogPlot(data)
     elif index ==1: pass # not a button
     elif index ==2: # set upper bound on linear plot
         if not data.log: data.edit[1] = True
@@ -429,15 +469,59 @@ def plotMousePressed(event,canvas,data):
         if bheight < event.y < bheight*2: pressRight(canvas,data,0)
         elif bheight*3 < event.y < bheight*4: pressRight(canvas,data,1)
         elif bheight*5 < event.y < bheight*6: pressRight(canvas,data,2)
+    # auto bounds button
+    elif 4*bwidth/3 < event.x < 5*bwidth/3:
+        if bheight*5 < event.y < bheight*6 and not data.log: autoBounds(data)
     # graph clicks
     if (data.edit[0] or data.edit[1]) and data.graph.inGraph(event.x,event.y):
         boundLine(data,event.x)
-
-def plotMouseMotion(event,data): pass
-
-def plotKeyPressed(event,data): pass
-
-def plotTimerFired(data): pass
+    # starts dragging a bound line
+    elif not data.log and data.graph.inGraph(event.x,event.y):
+        for i in range(2):
+            if data.bound[i] != None and abs(event.x-data.bound[i]) <= 5:
+                data.drag = i
+
+# This function sets both bounds to the window autoWindow picks.
+def autoBounds(data):
+    if data.sums == None: return
+    lb,ub = autoWindow(data.graph.points,data.sums)
+    if lb == None: return
+    data.lb,data.ub = lb,ub
+    data.bound = [data.graph.getCoord((lb,0))[0],
+        data.graph.getCoord((ub,0))[0]]
+    data.edit[0] = data.edit[1] = False
+    data.sums.fit(data,lb,ub)
+
+# This function moves the bound line being dragged, refitting the
+# data between the bounds as it goes.
+def dragBound(data, x):
+    xl,yl,xu,yu = data.graph.axisLimits
+    x = min(max(x,xl),xu)
+    data.bound[data.drag] = x
+    # finds the x point in graph units
+    if data.drag == 0: data.lb = data.graph.getPoint((x,0))[0]
+    else: data.ub = data.graph.getPoint((x,0))[0]
+    if data.sums != None:
+        lb = data.lb if data.bound[0] != None else None
+        ub = data.ub if data.bound[1] != None else None
+        data.sums.fit(data,lb,ub)
+
+def plotMouseMotion(event,data):
+    if data.drag != None: dragBound(data,event.x)
+
+def plotMouseReleased(event,data):
+    data.drag = None
+
+def plotKeyPressed(event,data):
+    if event.keysym == "s": # toggles the stats overlay
+        data.showStats = not data.showStats
+        STATS.enabled = data.showStats or STATS.log != ""
+    elif event.keysym == "a": # toggles averaging
+        data.average = not data.average
+    elif event.keysym == "w": # toggles windowed transfers
+        data.windowed = not data.windowed
+
+def plotTimerFired(data): return False
 
 # This function draws all the buttons in "plot" mode.
 def drawButtons(data,canvas): 
@@ -453,7 +537,11 @@ def drawButtons(data,canvas):
             canvas.create_rectangle(x1,y1,x2,y2,fill="white")
             # each button has specific text
             fill = "black" 
-            if i == 0 and j == 0: text = "New Data"
+            if i == 0 and j == 0: 
+                if data.job != None: text = "Cancel"
+                elif data.average: text = "Average %d" % AVERAGE_SHOTS
+                else: text = "New Data"
+                if data.job == None and data.windowed: text += " (window)"
             elif i == 1 and j == 0: 
                 if data.log: text = "Show Linear Plot"
                 else: text = "Show Log Plot"
@@ -481,6 +569,13 @@ def drawButtons(data,canvas):
                     if data.edit[1]: fill = "red"
             canvas.create_text(x1+5,y1+5,anchor="nw",font="Arial 18 bold",
                 text=text,fill=fill)
+    # auto bounds button, between the set bound buttons
+    if not data.log:
+        x1,y1 = 4*bwidth/3+10,bheight*5
+        x2,y2 = 5*bwidth/3-10,bheight*6
+        canvas.create_rectangle(x1,y1,x2,y2,fill="white")
+        canvas.create_text((x1+x2)/2,(y1+y2)/2,font="Arial 18 bold",
+            text="Auto")
 
 # This function draws the boundary lines on the graph.
 def drawBoundLines(data, canvas):
@@ -499,26 +594,32 @@ def plotRedrawAll(canvas,data):
     else: data.graph.drawGraph(canvas)
     drawBoundLines(data,canvas)
     drawButtons(data,canvas)
-
+    # shows what the app is working on, or the fit of a dragged bound
+    text = statusText(data)
+    if text == "" and data.drag != None and data.sums != None:
+        text = "lifetime (ns): %8.4f  r^2: %8f" % (data.lifetime,data.r2)
+    canvas.create_text(data.width/2,20,text=text,font="Arial 20 bold")
+    if data.showStats: drawStats(data,canvas)
+
+# This function draws the stats overlay in the corner of the graph.
+def drawStats(data, canvas):
+    lines = STATS.report()
+    lines.append("frames: %d drawn, %d dropped" % (data.frames.rendered,
+        data.frames.dropped))
+    xl,yl,xu,yu = data.graph.axisLimits
+    canvas.create_text(xl+10,yl+10,anchor="nw",font="Arial 10",
+        text="\n".join(lines),fill="blue")
 
 ####################################
 # save mode #
 ####################################
 
 
-# This function saves the data to a txt file.
+# This function saves the data in the chosen formats.
 def save(data): 
-    name = data.name
-    foldName = data.foldName
-    fileName = foldName + "/" + name + ".txt"
-    # comma-separates all data for processing by mathematica
-    contents = str(data.lifetime) + ",\n" + str(data.r2) + ",\n"
-    for i in range(len(data.logGraph.points)):
-        x,z = data.logGraph.points[i]
-        y = search(data.graph.points, x)
-        line = str(x) + "," + str(y) + "," + str(z) + "\n"
-        contents += line
-    writeFile(fileName, contents)
+    row,col = data.selected
+    saveWell(data.foldName, data.name, row, col, data, data.graph.points,
+        data.logGraph.points, data.formats)
 
 # This function returns the name of the file (not the whole path) without 
 # its "." ending.
@@ -528,6 +629,7 @@ def trimFileName(fileName):
 # This function gets a file from the directory.
 def folderExplorer(data):
     location = os.getcwd()
+    import tkFileDialog
     name = tkFileDialog.askdirectory()
     if name == (): name = ""
     return name
@@ -550,9 +652,10 @@ def savePress(canvas, data, i):
         if data.name != "" and data.foldName != "":
             # prints status to show that it's computing
             canvas.create_text(data.width/2,20,text="Saving",
-                font="Arial 20 bold")
+                font="Arial 20 bold",tags="saving")
             canvas.update()
             save(data)
+            canvas.delete("saving")
             data.mode = "plot"
             row,col = data.selected
             data.color[row][col] = "green"
@@ -595,12 +698,11 @@ def saveMousePressed(event,canvas,data):
     # button press in main grid
     if left+namewidth < event.x < right:
         if top+nameheight < event.y < bot:
-            letters = ["A","B","C","D","E","F","G","H"]
             row = (event.y-top-nameheight)//squareheight
             col = (event.x-left-namewidth)//squarewidth
             data.selected = (row,col)
-            data.name = (letters[row] + "%02d-" + data.header[0] + 
-                data.rowName[row] + data.header[1] + data.colName[col]) % (col+1)
+            data.name = wellName(data,row,col)
+
 
 # This function reacts to user mouseover in the grid region.
 def saveMouseMotion(event,data): 
@@ -641,13 +743,15 @@ def saveKeyPressed(event,data):
         elif event.keysym == "BackSpace": data.header[i] = data.header[i][:-1]
         else: data.header[i] += event.char.upper()
 
-# This function reacts to lengths of time in save mode.
+# This function reacts to lengths of time in save mode, returning
+# whether the cursor blinked.
 def saveTimerFired(data): 
     # updates blinking cursor in edit mode
-    if data.time % 5 == 0 and (True in data.edit[2]
-        or True in data.edit[3] or True in data.edit[4]): 
-        data.pipe = not data.pipe
+    blink = data.time % 5 == 0 and (True in data.edit[2]
+        or True in data.edit[3] or True in data.edit[4])
+    if blink: data.pipe = not data.pipe
     data.time += 1
+    return blink
 
 # This function interprets true/false as a character for a cursor.
 def piping(pipe):
@@ -777,6 +881,7 @@ def saveRedrawAll(canvas,data):
     labelGrid(canvas,data)
     legend(canvas,data)
 
+
 ####################################
 # dispatcher #
 ####################################
@@ -791,43 +896,171 @@ def mouseMotion(event,data):
     if data.mode == "save": saveMouseMotion(event,data)
     elif data.mode == "plot": plotMouseMotion(event,data)
 
+def mouseReleased(event,data):
+    if data.mode == "plot": plotMouseReleased(event,data)
+
 def keyPressed(event,data): 
     if data.mode == "save": saveKeyPressed(event,data)
     elif data.mode == "plot": plotKeyPressed(event,data)
 
+# This function returns whether the timer changed the view.
 def timerFired(data): 
-    if data.mode == "save": saveTimerFired(data)
-    elif data.mode == "plot": plotTimerFired(data)
+    if data.mode == "save": return saveTimerFired(data)
+    elif data.mode == "plot": return plotTimerFired(data)
+    return False
 
 def redrawAll(canvas,data):
     if data.mode == "save": saveRedrawAll(canvas,data)
     elif data.mode == "plot": plotRedrawAll(canvas,data)
 
+####################################
+# retained drawing #
+####################################
+
+# This class stands in for the canvas in the redraw functions. It
+# keeps the items drawn in one frame and reuses them in the next, so
+# only the items whose coordinates or options changed are touched.
+# Items are matched by kind and draw order, and tagged with that key.
+class Scene(object):
+
+    def __init__(self,canvas):
+        self.canvas = canvas
+        self.items = {} # (kind,n) -> [item,coords,options]
+        self.order = [] # item keys in draw order, last frame
+        self.frame = [] # item keys in draw order, this frame
+        self.counts = {} # items of each kind drawn this frame
+        self.restack = False # whether items were created this frame
+
+    # This function starts a new frame.
+    def begin(self):
+        self.frame = []
+        self.counts = {}
+        self.restack = False
+
+    # This function draws an item, creating it only if it isn't
+    # already on the canvas.
+    def draw(self,kind,coords,options):
+        if len(coords) == 1: coords = tuple(coords[0])
+        n = self.counts.get(kind,0)
+        self.counts[kind] = n+1
+        key = (kind,n)
+        self.frame.append(key)
+        if key in self.items:
+            item,oldCoords,oldOptions = self.items[key]
+            # options can't be unset, so those items are remade
+            if set(options) != set(oldOptions): self.canvas.delete(item)
+            else:
+                if coords != oldCoords: self.canvas.coords(item,*coords)
+                changed = {}
+                for option in options:
+                    if options[option] != oldOptions[option]:
+                        changed[option] = options[option]
+                if changed != {}: self.canvas.itemconfig(item,**changed)
+                self.items[key] = [item,coords,options]
+                return item
+        create = getattr(self.canvas,"create_"+kind)
+        item = create(*coords,tags="%s%d" % key,**options)
+        STATS.count("canvas items created")
+        self.items[key] = [item,coords,options]
+        self.restack = True
+        return item
+
+    def create_rectangle(self,*coords,**options):
+        return self.draw("rectangle",coords,options)
+
+    def create_oval(self,*coords,**options):
+        return self.draw("oval",coords,options)
+
+    def create_line(self,*coords,**options):
+        return self.draw("line",coords,options)
+
+    def create_text(self,*coords,**options):
+        return self.draw("text",coords,options)
+
+    # This function ends a frame, removing the items that weren't
+    # drawn and restacking the rest if the draw order changed.
+    def end(self):
+        drawn = set(self.frame)
+        for key in self.items.keys():
+            if key not in drawn:
+                self.canvas.delete(self.items.pop(key)[0])
+        if self.restack or self.frame != self.order:
+            for key in self.frame:
+                self.canvas.tag_raise(self.items[key][0])
+        self.order = self.frame
+
+# This class limits redraws to one per frame. Redraw requests made
+# while a frame is already scheduled are folded into it and counted
+# as dropped.
+class Frames(object):
+
+    def __init__(self,delay=40):
+        self.delay = delay # shortest time between frames, in ms
+        self.pending = False # whether a frame is scheduled
+        self.last = 0 # time of the last frame
+        self.rendered = 0 # frames drawn
+        self.dropped = 0 # redraw requests folded into a frame
+
+    # This function marks the view as needing a redraw, returning
+    # how long to wait before drawing it, or None if a frame is
+    # already scheduled.
+    def request(self):
+        if self.pending:
+            self.dropped += 1
+            return None
+        self.pending = True
+        wait = self.last + self.delay/1000.0 - time.time()
+        return max(0,int(wait*1000))
+
+    # This function records a drawn frame.
+    def drawn(self):
+        self.pending = False
+        self.last = time.time()
+        self.rendered += 1
+
 ####################################
 # runUI function # from 15-112 #
 ####################################
 
 def runUI(width=300, height=300):
+    from Tkinter import Tk, Canvas
     def redrawAllWrapper(canvas, data):
-        canvas.delete(ALL)
-        redrawAll(canvas, data)
-        canvas.update()    
+        start = STATS.start()
+        try:
+            data.scene.begin()
+            redrawAll(data.scene, data)
+            data.scene.end()
+        finally: data.frames.drawn() # a failed frame mustn't stop redraws
+        canvas.update_idletasks()
+        STATS.stop("draw",start)
+
+    # schedules a redraw, at most one per frame
+    def requestRedraw(canvas, data):
+        wait = data.frames.request()
+        if wait == None: return
+        elif wait == 0: canvas.after_idle(redrawAllWrapper, canvas, data)
+        else: canvas.after(wait, redrawAllWrapper, canvas, data)
 
     def mousePressedWrapper(event, canvas, data):
         mousePressed(event, canvas, data)
-        redrawAllWrapper(canvas, data)
+        requestRedraw(canvas, data)
 
     def mouseMotionWrapper(event,canvas,data):
         mouseMotion(event,data)
-        redrawAllWrapper(canvas,data)
+        requestRedraw(canvas,data)
+
+    def mouseReleasedWrapper(event,canvas,data):
+        mouseReleased(event,data)
+        requestRedraw(canvas,data)
 
     def keyPressedWrapper(event, canvas, data):
         keyPressed(event, data)
-        redrawAllWrapper(canvas, data)
+        requestRedraw(canvas, data)
 
+    # redraws only when a job or the timer changed the view
     def timerFiredWrapper(canvas, data):
-        timerFired(data)
-        redrawAllWrapper(canvas, data)
+        polled = pollJob(data)
+        if timerFired(data) or polled: requestRedraw(canvas, data)
         # pause, then call timerFired again
         canvas.after(data.timerDelay, timerFiredWrapper, canvas, data)
     # Set up data and call init
@@ -841,6 +1074,8 @@ def runUI(width=300, height=300):
     root = Tk()
     canvas = Canvas(root, width=data.width, height=data.height)
     canvas.pack()
+    data.scene = Scene(canvas)
+    data.frames = Frames()
     # set up events
     root.bind("<Button-1>", lambda event:
                             mousePressedWrapper(event, canvas, data))
@@ -848,8 +1083,14 @@ def runUI(width=300, height=300):
                             keyPressedWrapper(event, canvas, data))
     root.bind("<Motion>", lambda event: 
                             mouseMotionWrapper(event, canvas, data))
+    root.bind("<ButtonRelease-1>", lambda event:
+                            mouseReleasedWrapper(event, canvas, data))
+    requestRedraw(canvas, data) # the first frame
     timerFiredWrapper(canvas, data)
     # and launch the app
     root.mainloop()  # blocks until window is closed
+    STATS.record(acquisition=data.acquisition)
 
-runUI(800,800)
+if __name__ == "__main__":
+    if len(sys.argv) > 1: main(sys.argv[1:])
+    else: runUI(800,800)
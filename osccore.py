@@ -0,0 +1,1712 @@
+
+# Jacqueline Lewis
+# osccore.py
+
+
+# Setup instructions
+
+# Make sure to install python module vxi11.
+# > sudo pip install python-vxi11
+
+# ip directions
+# > hostname -I
+# choose the ip address starting with 169
+# change the instrument ip address to this number with a different 4th field
+# i.e. pi says 169.254.5.136 -> for instrument use 169.254.5.1 etc.
+#
+# to change instrument ip address
+# utility -> system i/o -> i/o -> change instrument settings
+#
+# Without a scope, OSC_IP=sim (or --ip sim) uses the simulator in
+# sim.py instead, see openInstrument.
+
+
+# This file holds the oscilloscope interfacing, data conversion, fitting
+# and saving behind osc.py, so that they can be used without the UI.
+# It can also be run from the shell, see the command line section.
+
+
+import numpy as np
+import os
+import sys
+import threading
+import Queue
+import time
+
+
+##############################
+# oscilloscope interfacing
+##############################
+
+# the formats wells are saved in, see saveWell - set with the
+# OSC_FORMATS environment variable, e.g. OSC_FORMATS=txt,archive
+SAVE_FORMATS = os.environ.get("OSC_FORMATS", "txt").split(",")
+
+# numpy types of the binary curve encodings, keyed by encoding and
+# byte width - the scope sends the most significant byte first
+BINARY_TYPES = {("RIBINARY",1): ">i1", ("RIBINARY",2): ">i2",
+    ("RPBINARY",1): ">u1", ("RPBINARY",2): ">u2"}
+
+# the query for the limits of the curve data, see readLimit
+LIMITS_QUERY = ("*WAI;:WFMPRE:YOFF?;:WFMPRE:YMULT?;:WFMPRE:YZERO?;"
+    ":WFMPRE:XINCR?;:WFMPRE:XZERO?")
+
+# the commands capturing a single triggered shot, replying once it is
+# done, see captureShot
+CAPTURE = ":ACQUIRE:STOPAFTER SEQUENCE;:ACQUIRE:STATE ON;*OPC?"
+
+# the most bytes asked for in one read, so that a transfer can be
+# followed and cancelled between reads
+READ_CHUNK = 2**20
+
+# the instrument ip depends on the pi - see ip directions at top,
+# it can be overridden with the OSC_IP environment variable
+SCOPE_IP = os.environ.get("OSC_IP", "169.254.5.1")
+
+# the channel acquired and the points in its record - set with the
+# OSC_SOURCE and OSC_POINTS environment variables
+SOURCE = os.environ.get("OSC_SOURCE", "CH1")
+RECORD_LENGTH = int(os.environ.get("OSC_POINTS", 10000))
+
+# This function gives the errors raised when the link to the
+# instrument drops. vxi11 is only imported once an instrument is used,
+# and isn't needed for socket or simulated instruments.
+def linkErrors():
+    try: import vxi11
+    except ImportError: return (IOError, EOFError)
+    return (vxi11.vxi11.Vxi11Exception, IOError, EOFError)
+
+# This class talks to an instrument's raw socket server, e.g. port
+# 4000 of the scope or sim.py's server, with the same calls as a
+# vxi11 instrument. Commands and replies end with a newline.
+class SocketInstrument(object):
+
+    def __init__(self,host,port,timeout=10):
+        import socket
+        self.link = socket.create_connection((host,port),timeout)
+
+    def write(self,message):
+        self.link.sendall(message.encode() + b"\n")
+
+    # This function reads up to num bytes, as soon as any arrive.
+    def read_raw(self,num=-1):
+        if num < 0: num = 65536
+        raw = self.link.recv(num)
+        if raw == b"": raise EOFError("instrument closed the link")
+        return raw
+
+    # This function reads a reply up to its newline.
+    def read(self,num=-1):
+        parts = [self.read_raw(num)]
+        while not parts[-1].endswith(b"\n"):
+            parts.append(self.read_raw(num))
+        return b"".join(parts).decode().rstrip("\r\n")
+
+    def clear(self): pass
+
+    def close(self):
+        self.link.close()
+
+# This class counts the round trips made over an instrument link, for
+# the instrumentation. On vxi11 every call is one, waiting for the
+# instrument's reply.
+class CountedLink(object):
+
+    def __init__(self,instr):
+        self.instr = instr
+
+    def write(self,message):
+        STATS.count("round trips")
+        self.instr.write(message)
+
+    def read_raw(self,num=-1):
+        STATS.count("round trips")
+        return self.instr.read_raw(num)
+
+    def read(self,num=-1):
+        STATS.count("round trips")
+        return self.instr.read(num)
+
+    def clear(self):
+        STATS.count("round trips")
+        self.instr.clear()
+
+    def close(self):
+        self.instr.close()
+
+# This function opens a link to the instrument at an address, which is
+# either an ip for vxi11, TCPIP::<host>::<port>::SOCKET for a raw
+# socket, or sim for a new simulated scope.
+def openInstrument(ip):
+    fields = ip.split("::")
+    if len(fields) == 4 and fields[3].upper() == "SOCKET":
+        return SocketInstrument(fields[1],int(fields[2]))
+    elif ip == "sim":
+        import sim
+        return sim.Simulator().connect()
+    import vxi11
+    return vxi11.Instrument(ip)
+
+# This class keeps a single link to the oscilloscope open between
+# acquisitions, remembering the data setup already sent so that it is
+# only resent when a setting changes.
+class Scope(object):
+
+    # the data setup commands, in the order they are sent
+    SETUP = [("source",":DATA:SOURCE %s"),("start",":DATA:START %d"),
+        ("stop",":DATA:STOP %d"),("encoding",":DATA:ENCDG %s"),
+        ("width",":DATA:WIDTH %d"),("frameStart",":DATA:FRAMESTART %d"),
+        ("frameStop",":DATA:FRAMESTOP %d")]
+
+    def __init__(self,ip=SCOPE_IP,retries=1,link=openInstrument):
+        self.ip = ip # instrument address
+        self.retries = retries # reconnects allowed per request
+        self.link = link # opens a link to the instrument at ip
+        self.instr = None # instrument link, opened on first use
+        self.settings = {} # data setup the instrument currently has
+        self.preambles = {} # limits and points of each source's record
+
+    # This function opens the link if it isn't already open.
+    def connect(self):
+        if self.instr is None:
+            self.instr = CountedLink(self.link(self.ip))
+            self.instr.clear()
+            self.settings = {}
+        return self.instr
+
+    # This function drops the link, forgetting the instrument setup.
+    def close(self):
+        if self.instr is not None:
+            try: self.instr.close()
+            except linkErrors(): pass
+        self.instr = None
+        self.settings = {}
+
+    # This function gives the setup commands for the settings that
+    # differ from the cached instrument setup, to be sent ahead of the
+    # next message, and caches them.
+    def setup(self,**settings):
+        commands = []
+        for (key,command) in Scope.SETUP:
+            if key in settings and self.settings.get(key) != settings[key]:
+                commands.append(command % settings[key] + ";")
+        self.settings.update(settings)
+        return "".join(commands)
+
+    # This function sends the setup commands for the settings that
+    # differ from the cached instrument setup.
+    def configure(self,**settings):
+        instr = self.connect()
+        commands = self.setup(**settings)
+        if commands != "": instr.write(commands)
+        return instr
+
+    # This function calls request with the configured instrument,
+    # reconnecting and retrying if the link drops.
+    def run(self,request,**settings):
+        for attempt in range(self.retries+1):
+            try:
+                return request(self.configure(**settings))
+            except linkErrors():
+                self.close()
+                if attempt == self.retries: raise
+
+# This error stops a transfer that has been cancelled.
+class Cancelled(Exception): pass
+
+# This class tracks a transfer, so that another thread can show how
+# far along it is or cancel it.
+class Progress(object):
+
+    def __init__(self):
+        self.received = 0 # bytes received so far
+        self.total = 0 # bytes expected, 0 while unknown
+        self.cancelled = False
+        self.partial = None # latest partial result, for showing
+
+    # This function counts newly received bytes, stopping the
+    # transfer if it has been cancelled.
+    def update(self,count):
+        if self.cancelled: raise Cancelled()
+        self.received += count
+
+    def cancel(self):
+        self.cancelled = True
+
+
+##############################
+# instrumentation
+##############################
+
+# the file instrumentation records are appended to, a JSON object per
+# line - set with the OSC_STATS environment variable, which turns the
+# instrumentation on
+STATS_LOG = os.environ.get("OSC_STATS", "")
+
+# This class collects the time spent in each stage of the pipeline and
+# counts such as bytes transferred, from any thread, until they are
+# recorded. While it is disabled, start returns None and nothing else
+# is done, so the stages only pay for one check.
+class Stats(object):
+
+    def __init__(self,log=STATS_LOG):
+        self.log = log # file records are appended to, "" for none
+        self.enabled = log != ""
+        self.lock = threading.Lock()
+        self.reset()
+
+    # This function clears the collected stages and counts.
+    def reset(self):
+        self.seconds = {} # total time, by stage
+        self.calls = {} # times run, by stage
+        self.last = {} # time of the last run, by stage
+        self.counts = {} # totals, by name
+
+    # This function starts timing a stage, returning its start time,
+    # or None if disabled.
+    def start(self):
+        if self.enabled: return time.time()
+        return None
+
+    # This function ends the timing of a stage begun with start.
+    def stop(self,stage,start):
+        if start == None: return
+        seconds = time.time()-start
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage,0) + seconds
+            self.calls[stage] = self.calls.get(stage,0) + 1
+            self.last[stage] = seconds
+
+    # This function adds to a count.
+    def count(self,name,amount=1):
+        if not self.enabled: return
+        with self.lock: self.counts[name] = self.counts.get(name,0) + amount
+
+    # This function gives the peak memory of the process, in MB.
+    def memory(self):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+    # This function appends what has been collected to the log file,
+    # with any other fields given, and starts collecting afresh.
+    def record(self,**fields):
+        if not self.enabled: return
+        import json
+        with self.lock:
+            if self.calls != {} and self.log != "":
+                fields.update(time=time.time(),seconds=self.seconds,
+                    calls=self.calls,counts=self.counts,
+                    peakMB=self.memory())
+                with open(self.log,"at") as f:
+                    f.write(json.dumps(fields,sort_keys=True) + "\n")
+            self.reset()
+
+    # This function describes the collected stages and counts, a line
+    # each.
+    def report(self):
+        with self.lock:
+            lines = ["%s: %.1f ms, %d runs, %.1f ms total" % (stage,
+                self.last[stage]*1000,self.calls[stage],
+                self.seconds[stage]*1000) for stage in sorted(self.calls)]
+            lines += ["%s: %d" % (name,self.counts[name])
+                for name in sorted(self.counts)]
+        lines.append("peak memory: %.1f MB" % self.memory())
+        return lines
+
+# the instrumentation of this process
+STATS = Stats()
+
+# This function gets raw data from the oscilloscope, length points of
+# the record of source from sample start (the first being 1). The
+# encoding is either "ASCII" or one of the binary encodings in
+# BINARY_TYPES. With capture, a new shot is captured for it, leaving
+# the scope stopped, see resumeRun.
+def acquireData(scope, encoding="RIBINARY", width=2, progress=None,
+        source=SOURCE, length=RECORD_LENGTH, start=1, capture=False):
+    if progress == None: progress = Progress()
+    return scope.run(lambda instr: queryData(instr,encoding,width,progress,
+        length,capture=capture),source=source,start=start,stop=start+length-1,
+        encoding=encoding,width=width)
+
+# This function queries the data limits from a configured instrument.
+def queryLimits(instr):
+    instr.write(LIMITS_QUERY)
+    return str(instr.read(num=1024)).split(";")
+
+# This function queries the limits and data points from a configured
+# instrument. Both are asked for in one message and come back in one
+# reply, the limits then the curve, so that a transfer takes a single
+# round trip to the instrument ahead of its data. Commands to send
+# first can be given, and with capture, a new shot is captured first
+# in the same message.
+def queryData(instr, encoding, width, progress, length=RECORD_LENGTH,
+        commands="", capture=False):
+    if capture: commands += CAPTURE + ";"
+    instr.write(commands + LIMITS_QUERY + ";CURVE?")
+    # the reply to *OPC? comes ahead of the limits
+    limits, head = readFields(instr, 6 if capture else 5, progress)
+    limits = limits[-5:]
+    if encoding != "ASCII":
+        # binary data comes as a single block
+        return limits, readBinary(instr, encoding, width, progress,
+            head=head)
+    return limits, readAscii(instr, length, progress, head=head)
+
+# This function reads the first count ;-separated fields of a reply,
+# returning them and the bytes read past them.
+def readFields(instr, count, progress, chunk=READ_CHUNK):
+    raw = b""
+    while raw.count(b";") < count:
+        more = instr.read_raw(num=chunk)
+        if more == b"": raise ValueError("incomplete reply")
+        progress.update(len(more))
+        raw += more
+    fields = raw.split(b";", count)
+    return [field.decode() for field in fields[:count]], fields[count]
+
+# This function captures a single triggered shot, waiting until it is
+# done, so that the channels can be read from the same shot. Commands
+# to send first can be given.
+def captureShot(instr, commands=""):
+    instr.write(commands + CAPTURE)
+    instr.read(num=1024)
+
+# This function sets the scope acquiring continuously again, after
+# captureShot. Commands to send first can be given.
+def resumeRun(instr, commands=""):
+    instr.write(commands + ":ACQUIRE:STOPAFTER RUNSTOP;:ACQUIRE:STATE ON")
+
+# This function gets raw data from several channels of one shot,
+# returning the limits and data of each.
+def acquireChannels(scope, sources, encoding="RIBINARY", width=2,
+        progress=None, length=RECORD_LENGTH):
+    if progress == None: progress = Progress()
+    def request(instr):
+        captureShot(instr)
+        channels = []
+        for source in sources:
+            channels.append(queryData(instr,encoding,width,progress,length,
+                scope.setup(source=source)))
+        resumeRun(instr)
+        return channels
+    return scope.run(request,source=sources[0],start=1,stop=length,
+        encoding=encoding,width=width)
+
+# This function captures frames triggered shots into the scope's
+# segmented (FastFrame) memory, then gets them all in one binary
+# transfer, returning the limits and a (frames x samples) array of raw
+# curve values.
+def acquireFrames(scope, frames, encoding="RIBINARY", width=2,
+        progress=None, source=SOURCE, length=RECORD_LENGTH, start=1):
+    if progress == None: progress = Progress()
+    return scope.run(lambda instr: queryFrames(instr,frames,encoding,width,
+        progress,length),source=source,start=start,stop=start+length-1,
+        encoding=encoding,width=width,frameStart=1,frameStop=frames)
+
+# This function captures and queries the frames from a configured
+# instrument, leaving it acquiring single shots again.
+def queryFrames(instr, frames, encoding, width, progress,
+        length=RECORD_LENGTH):
+    captureShot(instr,":HORIZONTAL:FASTFRAME:COUNT %d;"
+        ":HORIZONTAL:FASTFRAME:STATE ON;" % frames)
+    limits, data = queryData(instr, encoding, width, progress,
+        frames*length)
+    resumeRun(instr,":HORIZONTAL:FASTFRAME:STATE OFF;")
+    return limits, data.reshape(frames,-1)
+
+# This function reads comma-separated curve data as it arrives, after
+# any already read in head, parsing each chunk into a preallocated
+# array. Partial values are carried over to the next chunk, and reading
+# stops at the terminator or once all points are in. The reads double
+# in size up to READ_CHUNK, as the length isn't known.
+def readAscii(instr, points, progress, chunk=4096, head=b""):
+    data = np.empty(points)
+    count = 0
+    partial = b""
+    while count < points:
+        if head != b"": raw,head = head,b""
+        else:
+            raw = instr.read_raw(num=chunk)
+            progress.update(len(raw))
+            chunk = min(2*chunk, READ_CHUNK)
+        text = partial + raw
+        end = text.find(b"\n")
+        last = end >= 0 or raw == b""
+        if end >= 0: text = text[:end]
+        if not last: # keeps the unfinished value for the next chunk
+            cut = text.rfind(b",")
+            text,partial = text[:cut+1],text[cut+1:]
+        values = np.fromstring(text, sep=",")[:points-count]
+        data[count:count+len(values)] = values
+        count += len(values)
+        if last: break
+    return data[:count]
+
+# This function reads a binary curve block, after any already read in
+# head, in reads sized to the rest of the block up to chunk, so that
+# the transfer can be followed and cancelled between them.
+def readBinary(instr, encoding, width, progress, chunk=READ_CHUNK,
+        head=b""):
+    raw = head
+    # reads until the length in the block header is in
+    while not blockHeaderRead(raw):
+        more = instr.read_raw(num=chunk)
+        if more == b"": break
+        progress.update(len(more))
+        raw += more
+    begin,length = blockHeader(raw)
+    progress.total = progress.received + begin+length-len(raw)
+    parts = [raw]
+    have = len(raw)
+    while have < begin+length:
+        # asks for one more byte than the block for the terminator
+        raw = instr.read_raw(num=min(chunk, begin+length-have+1))
+        if raw == b"": break
+        progress.update(len(raw))
+        parts.append(raw)
+        have += len(raw)
+    return readBlock(b"".join(parts), encoding, width)
+
+# This function tells whether the header of a block has been read.
+def blockHeaderRead(raw):
+    start = raw.find(b"#")
+    if start < 0 or len(raw) < start+2: return False
+    return not raw[start+1:start+2].isdigit() or (
+        len(raw) >= start+2+int(raw[start+1:start+2]))
+
+# This function finds where the payload of an IEEE 488.2 definite
+# length block (#<digits><length><payload>) begins, and its length.
+def blockHeader(raw):
+    start = raw.find(b"#")
+    if start < 0: raise ValueError("no block header in curve data")
+    digits = int(raw[start+1:start+2])
+    if digits == 0: raise ValueError("bad block header in curve data")
+    return start+2+digits,int(raw[start+2:start+2+digits])
+
+# This function decodes an IEEE 488.2 definite length block into an
+# array of raw curve values.
+def readBlock(raw, encoding, width):
+    begin,length = blockHeader(raw)
+    if len(raw) < begin+length:
+        raise ValueError("incomplete curve data block")
+    return np.frombuffer(raw[begin:begin+length],
+        dtype=BINARY_TYPES[(encoding,width)])
+
+# This function reads the raw limit data from the oscilloscope.
+def readLimit(limit):
+    splt = limit.split("E")
+    if len(splt) > 1:
+        return float(splt[0]) * (10.0 ** float(splt[1]))
+    else:
+        return float(limit)
+
+# This function converts an array of raw curve values using the
+# provided limits.
+def readCurve(limits, data, dtype=np.float64):
+    yoff, ymult, yzero, xincr, xzero = limits
+    return (data.astype(dtype)-yoff)*ymult + yzero
+
+# This function provides the time data points.
+def buildPoints(limits, data):
+    yoff, ymult, yzero, xincr, xzero = limits
+    return Waveform(data, xzero, xincr, limits)
+
+# This function determines the min max data points.
+def getEdges(points):
+    return ((points.time(0),points.time(len(points)-1)),
+        (points.ys.min(),points.ys.max()))
+
+# This function connects all interfacing functions to return
+# readable data points and limits. Given a later first sample, see
+# sampleWindow, only part of the record is transferred. With capture,
+# the data is of a newly captured shot, see acquireData.
+def getData(scope, encoding="RIBINARY", width=2, progress=None,
+        source=SOURCE, length=RECORD_LENGTH, first=1, capture=False):
+    if progress == None: progress = Progress()
+    start = STATS.start()
+    try:
+        limits, data = acquireData(scope, encoding, width, progress, source,
+            length, first, capture)
+    except ValueError:
+        # falls back to the slower ascii transfer on a bad block,
+        # on a fresh link so no partial block is left to read
+        scope.close()
+        limits, data = acquireData(scope, "ASCII", width, progress, source,
+            length, first, capture)
+    STATS.stop("transfer",start)
+    STATS.count("bytes transferred",progress.received)
+    STATS.count("transfers")
+    start = STATS.start()
+    limits = recordLimits(scope, source, map(readLimit, limits), first,
+        length)
+    if limits == None:
+        # the timebase changed since the window was picked, so the
+        # whole record is transferred instead, keeping its limits
+        points = scope.preambles.pop(source)[1]
+        return getData(scope, encoding, width, progress, source, points,
+            capture=capture)
+    data = readCurve(limits, data)
+    points = buildPoints(limits, data)
+    xlim,ylim = getEdges(points)
+    STATS.stop("convert",start)
+    STATS.count("points parsed",len(points))
+    return points,xlim,ylim
+
+# This function gets frames shots in one transfer, see acquireFrames,
+# as a (frames x samples) array of voltages with their sample times,
+# xzero + xincr * (sample index).
+def getFrames(scope, frames, encoding="RIBINARY", width=2, progress=None,
+        source=SOURCE, length=RECORD_LENGTH, first=1):
+    if progress == None: progress = Progress()
+    start = STATS.start()
+    limits, data = acquireFrames(scope, frames, encoding, width, progress,
+        source, length, first)
+    STATS.stop("transfer",start)
+    STATS.count("bytes transferred",progress.received)
+    STATS.count("transfers")
+    start = STATS.start()
+    limits = recordLimits(scope, source, map(readLimit, limits), first,
+        length)
+    if limits == None: # the timebase changed, see getData
+        points = scope.preambles.pop(source)[1]
+        return getFrames(scope, frames, encoding, width, progress, source,
+            points)
+    yoff, ymult, yzero, xincr, xzero = limits
+    ys = readCurve(limits, data)
+    STATS.stop("convert",start)
+    STATS.count("points parsed",ys.size)
+    return ys,xzero,xincr,limits
+
+# This function keeps the limits of a transfer of length points from
+# the start of the record of source. For a later first sample, it
+# times the transfer from the start of the record kept, so that its x
+# axis matches the whole record's whichever XZERO the instrument gave,
+# the XZERO of the record or of the first sample sent. If the XINCR or
+# XZERO given doesn't match the record kept, the timebase has changed
+# and the window was picked from stale limits, and it returns None.
+def recordLimits(scope, source, limits, first, length):
+    if first == 1:
+        scope.preambles[source] = (limits, length)
+        return limits
+    elif source not in scope.preambles: return limits
+    xincr, xzero = limits[3:5]
+    whole = scope.preambles[source][0][4]
+    start = whole + xincr*(first-1)
+    if (not np.isclose(xincr, scope.preambles[source][0][3], rtol=1e-6) or
+            min(abs(xzero-whole), abs(xzero-start)) > xincr/2):
+        return None
+    return limits[:4] + [start]
+
+# This function gives the limits of the record of source, from the
+# last transfer from its start or from a query.
+def getPreamble(scope, source=SOURCE, length=RECORD_LENGTH):
+    if source not in scope.preambles:
+        limits = scope.run(queryLimits,source=source,start=1,stop=length)
+        scope.preambles[source] = (map(readLimit, limits), length)
+    return scope.preambles[source][0]
+
+# This function turns fit bounds lb to ub (s) into the first sample
+# and number of samples to transfer for them, widened on each side by
+# margin times the window, and kept within the record.
+def sampleWindow(scope, lb, ub, margin=0.1, source=SOURCE,
+        length=RECORD_LENGTH):
+    yoff, ymult, yzero, xincr, xzero = getPreamble(scope, source, length)
+    pad = margin*(ub-lb)
+    first = max(int(np.floor((lb-pad-xzero)/xincr)),0)
+    last = min(int(np.ceil((ub+pad-xzero)/xincr)),length-1)
+    if last < first: return 1,length
+    return first+1,last-first+1
+
+# This function gets one shot of several channels, e.g. the trace and
+# a laser reference, as a (channels x samples) array of voltages on a
+# common time base, xzero + xincr * (sample index), with the limits of
+# each channel. Channels starting at different times are cut to the
+# times they all cover.
+def getChannels(scope, sources, encoding="RIBINARY", width=2, progress=None,
+        length=RECORD_LENGTH):
+    if progress == None: progress = Progress()
+    start = STATS.start()
+    channels = acquireChannels(scope, sources, encoding, width, progress,
+        length)
+    STATS.stop("transfer",start)
+    STATS.count("bytes transferred",progress.received)
+    STATS.count("transfers",len(sources))
+    start = STATS.start()
+    waves = []
+    for (limits, data) in channels:
+        limits = map(readLimit, limits)
+        waves.append(buildPoints(limits, readCurve(limits, data)))
+    ys,xzero,xincr = alignChannels(waves)
+    STATS.stop("convert",start)
+    STATS.count("points parsed",ys.size)
+    return ys,xzero,xincr,[wave.preamble for wave in waves]
+
+# This function lines up the samples of channels sharing a sample
+# spacing, returning them as rows of an array with the time of its
+# first column and the spacing.
+def alignChannels(waves):
+    xincr = waves[0].xincr
+    if any(not np.isclose(wave.xincr,xincr) for wave in waves):
+        raise ValueError("channels have different sample spacings")
+    xzero = min(wave.xzero for wave in waves)
+    # the samples of each channel on a time base starting at xzero
+    offsets = [int(round((wave.xzero-xzero)/xincr)) for wave in waves]
+    lo = max(offsets)
+    hi = min(offset+len(wave) for (offset,wave) in zip(offsets,waves))
+    ys = np.empty((len(waves),max(hi-lo,0)))
+    for (i,(offset,wave)) in enumerate(zip(offsets,waves)):
+        ys[i] = wave.ys[lo-offset:hi-offset]
+    return ys,xzero+lo*xincr,xincr
+
+# This function gives the spread of the lifetimes (ns) of the frames
+# of an acquisition, fitting each over lb to ub as fitTraces does.
+def frameLifetimes(ys, xzero, xincr, lb=None, ub=None, model="loglinear"):
+    fits = fitTraces(ys,xzero,xincr,lb,ub,model)
+    lifetimes = fits.lifetime[:,0]
+    lifetimes = lifetimes[np.isfinite(lifetimes)]
+    if len(lifetimes) == 0: return fits,np.nan,np.nan,np.nan
+    deviation = lifetimes.std(ddof=1) if len(lifetimes) > 1 else np.nan
+    return (fits,lifetimes.mean(),deviation,
+        deviation/np.sqrt(len(lifetimes)))
+
+# This class keeps the running mean and variance of the shots of an
+# averaged acquisition. Each shot is folded in as it arrives (Welford's
+# method), in place, so memory doesn't grow with the number of shots.
+class Average(object):
+
+    def __init__(self):
+        self.count = 0 # shots folded in
+        self.mean = None # mean voltage of each point
+        self.m2 = None # summed squared deviations of each point
+        self.first = None # first shot, for its times and limits
+
+    # This function folds in a shot.
+    def add(self,points):
+        if self.count == 0:
+            self.first = points
+            self.mean = points.ys.astype(np.float64)
+            self.m2 = np.zeros(len(points))
+            self.delta = np.empty(len(points))
+            self.step = np.empty(len(points))
+        elif len(points) != len(self.mean):
+            raise ValueError("shot has %d points, not %d" % (len(points),
+                len(self.mean)))
+        else:
+            np.subtract(points.ys,self.mean,out=self.delta)
+            np.multiply(self.delta,1.0/(self.count+1),out=self.step)
+            self.mean += self.step
+            np.subtract(points.ys,self.mean,out=self.step)
+            self.step *= self.delta
+            self.m2 += self.step
+        self.count += 1
+
+    # This function folds in a (frames x samples) array of shots at
+    # once, combining their mean and variance with the running ones.
+    def addFrames(self,ys,xzero,xincr,preamble=None):
+        if self.count == 0:
+            self.add(Waveform(ys[0],xzero,xincr,preamble))
+            ys = ys[1:]
+        count = len(ys)
+        if count == 0: return
+        elif ys.shape[1] != len(self.mean):
+            raise ValueError("shot has %d points, not %d" % (ys.shape[1],
+                len(self.mean)))
+        mean = ys.mean(axis=0)
+        m2 = ((ys-mean)**2).sum(axis=0)
+        total = self.count+count
+        np.subtract(mean,self.mean,out=self.delta)
+        self.m2 += m2 + self.delta**2*(self.count*count/float(total))
+        self.mean += self.delta*(count/float(total))
+        self.count = total
+
+    # This function gives the standard error of the mean of each point.
+    def error(self):
+        if self.count < 2: return np.full(len(self.mean),np.inf)
+        return np.sqrt(self.m2/((self.count-1)*self.count))
+
+    # This function gives the typical standard error of the points,
+    # their median.
+    def typicalError(self):
+        if self.count < 2: return np.inf
+        return np.sqrt(np.median(self.m2)/((self.count-1)*self.count))
+
+    # This function gives the signal to noise ratio of the mean, its
+    # peak over the typical standard error.
+    def snr(self):
+        with np.errstate(divide="ignore"):
+            return np.abs(self.mean).max()/self.typicalError()
+
+    # This function gives the mean as a Waveform, with its edges.
+    def points(self):
+        first = self.first
+        points = Waveform(self.mean.copy(),first.xzero,first.xincr,
+            first.preamble,first.index)
+        xlim,ylim = getEdges(points)
+        return points,xlim,ylim
+
+# This function averages up to shots acquisitions, stopping early once
+# the signal to noise ratio reaches snr. With frames, up to that many
+# shots are taken in each transfer, see getFrames, and otherwise each
+# shot is captured before it is read, so that none is read twice. shot
+# is called with the Average after each transfer, e.g. to show it
+# converging.
+def getAverage(scope, shots, snr=None, encoding="RIBINARY", width=2,
+        progress=None, shot=None, frames=1, source=SOURCE,
+        length=RECORD_LENGTH, first=1):
+    if progress == None: progress = Progress()
+    average = Average()
+    captured = False # whether the scope was left stopped on a shot
+    try:
+        while average.count < shots:
+            progress.received = progress.total = 0
+            count = min(frames,shots-average.count)
+            if count > 1:
+                ys,xzero,xincr,limits = getFrames(scope,count,encoding,
+                    width,progress,source,length,first)
+            else:
+                captured = True
+                wave,xlim,ylim = getData(scope,encoding,width,progress,
+                    source,length,first,capture=True)
+            samples = ys.shape[1] if count > 1 else len(wave)
+            if samples != length:
+                # the timebase changed, see getData, so the average
+                # starts again on whole records
+                first,length = 1,samples
+                average = Average()
+            start = STATS.start()
+            if count > 1: average.addFrames(ys,xzero,xincr,limits)
+            else: average.add(wave)
+            STATS.stop("average",start)
+            if shot != None: shot(average)
+            if snr != None and average.snr() >= snr: break
+    finally:
+        if captured:
+            # sets the scope running again, unless the link is down
+            try: scope.run(resumeRun)
+            except linkErrors(): pass
+    return average.points()
+
+
+################################
+######## WAVEFORM CLASS ########
+################################
+
+# This class holds a trace as one array of voltages. The time of
+# each point is implicit, xzero + xincr * (sample index), and sample
+# indices are only stored once points have been dropped.
+class Waveform(object):
+
+    def __init__(self,ys,xzero,xincr,preamble=None,index=None):
+        self.ys = ys # voltages, or log voltages
+        self.xzero = xzero # time of the first sample
+        self.xincr = xincr # time between samples
+        self.preamble = preamble # scope limits the data came with
+        self.index = index # sample indices, None when contiguous
+
+    def __len__(self):
+        return len(self.ys)
+
+    # This function gives the sample index of each point.
+    def indices(self):
+        if self.index is None: return np.arange(len(self.ys))
+        return self.index
+
+    # This function gives the time of each point.
+    def xs(self):
+        return self.xzero + self.xincr*self.indices()
+
+    # This function gives the time of the point at position i.
+    def time(self,i):
+        index = i if self.index is None else self.index[i]
+        return self.xzero + self.xincr*index
+
+    # This function keeps the points picked out by a slice or mask.
+    def select(self,keep):
+        return Waveform(self.ys[keep],self.xzero,self.xincr,
+            self.preamble,self.indices()[keep])
+
+    # This function gives the voltages at the given sample indices.
+    def at(self,index):
+        if self.index is None: return self.ys[index]
+        return self.ys[np.searchsorted(self.index,index)]
+
+    # This function finds the first point after time t, or at t
+    # unless right is set. The guess from the sample spacing is
+    # checked against the point times, as xs would give them.
+    def find(self,t,right=False):
+        sample = (t-self.xzero)/self.xincr
+        if self.index is None: i = int(min(max(np.ceil(sample),0),len(self)))
+        else: i = int(np.searchsorted(self.index,sample))
+        def before(i):
+            x = self.time(i)
+            return x <= t if right else x < t
+        while i > 0 and not before(i-1): i -= 1
+        while i < len(self) and before(i): i += 1
+        return i
+
+    # This function keeps the points from time lb to ub, a bound of
+    # None leaving that side open. The voltages are not copied.
+    def window(self,lb,ub):
+        lo = 0 if lb == None else self.find(lb)
+        hi = len(self) if ub == None else max(lo,self.find(ub,True))
+        if self.index is None: index = np.arange(lo,hi)
+        else: index = self.index[lo:hi]
+        return Waveform(self.ys[lo:hi],self.xzero,self.xincr,
+            self.preamble,index)
+
+    # This function takes the log of the points, dropping those
+    # without one.
+    def log(self):
+        keep = self.ys > 0
+        if keep.all(): wave = self.select(slice(None))
+        else: wave = self.select(keep)
+        wave.ys = np.log(wave.ys)
+        return wave
+
+
+####################################
+# fitting #
+####################################
+
+# This function gets the log of the points within the bounds. If a
+# bound isn't set, all points on that side are in.
+def logData(points,data):
+    lb = data.lb if data.bound[0] != None else None
+    ub = data.ub if data.bound[1] != None else None
+    return points.window(lb,ub).log()
+
+# This function determines the lifetime and r2 value for
+# the log graph.
+def linReg(data,points):
+    start = STATS.start()
+    # converts data to solver format
+    x = points.xs()
+    y = points.ys
+    n = np.size(x)
+    # calculates slope
+    m_x,m_y = np.mean(x),np.mean(y)
+    SS_xy = np.sum(y*x) - n*m_y*m_x
+    SS_xx = np.sum(x*x) - n*m_x*m_x
+    b_1 = SS_xy / SS_xx
+    b_0 = m_y - b_1*m_x
+    data.yint = b_0
+    data.slope = b_1
+    # calculates r2
+    yhat = b_1*x+b_0
+    SSR = np.sum((yhat-m_y)**2)
+    SSTO = np.sum((y-m_y)**2)
+    data.r2 = SSR/SSTO
+    data.lifetime = -(10**9)/b_1
+    STATS.stop("fit",start)
+
+# This class holds running sums over the log of the points of a
+# trace, made once per acquisition, so that the linReg fit of any
+# window of it takes near constant time. The sums are kept at the
+# edges of blocks of points, about 65536 of them whatever the record
+# length, and the points of partly covered blocks are summed directly.
+# Sums are over sample indices, which keeps them exact for long traces.
+class CumulativeFit(object):
+
+    def __init__(self,points,block=None):
+        self.points = points
+        self.xzero = points.xzero
+        self.xincr = points.xincr
+        if block == None: block = max(1,len(points)//2**16)
+        self.block = block
+        blocks = len(points)//block
+        # count, x, y, xy, xx and yy summed up to each block edge,
+        # a chunk of points at a time to keep memory down
+        self.sums = np.zeros((6,blocks+1))
+        chunk = max(1,2**20//block)*block
+        for lo in range(0,blocks*block,chunk):
+            hi = min(lo+chunk,blocks*block)
+            terms = self.terms(lo,hi).reshape(6,-1,block).sum(axis=2)
+            self.sums[:,lo//block+1:hi//block+1] = terms
+        np.cumsum(self.sums,axis=1,out=self.sums)
+
+    # This function gives the terms summed for the points from lo to
+    # hi, a row each.
+    def terms(self,lo,hi):
+        ys = self.points.ys[lo:hi]
+        valid = ys > 0 # points with a log
+        index = self.points.index
+        x = np.arange(lo,hi) if index is None else index[lo:hi]
+        x = np.where(valid,x,0).astype(np.float64)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            y = np.where(valid,np.log(ys),0)
+        return np.array([valid,x,y,x*y,x*x,y*y])
+
+    # This function sums the terms of the points from lo to hi, from
+    # the block sums unless the window covers only a few blocks.
+    def sum(self,lo,hi):
+        first,last = -(-lo//self.block),hi//self.block
+        if last-first < 64: return self.terms(lo,hi).sum(axis=1)
+        return (self.sums[:,last]-self.sums[:,first] +
+            self.terms(lo,first*self.block).sum(axis=1) +
+            self.terms(last*self.block,hi).sum(axis=1))
+
+    # This function fits the log of the points from lb to ub as
+    # linReg does, a bound of None leaving that side open.
+    def fit(self,data,lb,ub):
+        points = self.points
+        lo = 0 if lb == None else points.find(lb)
+        hi = len(points) if ub == None else max(lo,points.find(ub,True))
+        n,S_x,S_y,S_xy,S_xx,S_yy = self.sum(lo,hi)
+        data.slope = data.yint = data.r2 = data.lifetime = np.nan
+        if n < 2: return data.lifetime
+        SS_xy = S_xy - S_x*S_y/n
+        SS_xx = S_xx - S_x*S_x/n
+        SS_yy = S_yy - S_y*S_y/n
+        # slope per sample converted to per second
+        b_1 = SS_xy/SS_xx/self.xincr
+        data.slope = b_1
+        data.yint = S_y/n - SS_xy/SS_xx*S_x/n - b_1*self.xzero
+        data.r2 = SS_xy*SS_xy/(SS_xx*SS_yy)
+        data.lifetime = -(10**9)/b_1
+        return data.lifetime
+
+# This function finds where the decay after the peak reaches the noise
+# floor: the first point from which the mean of the next width points
+# is within level noise deviations of the baseline. The noise is taken
+# from the spread of neighbouring points, the baseline from the last
+# tenth of the trace.
+def noiseFloor(points, peak, width=None, level=3):
+    ys = points.ys
+    if width == None: width = max(1,len(ys)//200)
+    noise = np.median(np.abs(np.diff(ys)))/(0.6745*np.sqrt(2))
+    baseline = np.median(ys[-max(1,len(ys)//10):])
+    sums = np.concatenate(([0],np.cumsum(ys[peak:],dtype=np.float64)))
+    means = (sums[width:]-sums[:-width])/width
+    below = np.flatnonzero(means <= baseline + level*noise)
+    if len(below) == 0: return len(ys)
+    return peak + below[0]
+
+# This function estimates the width of the instrument response from
+# the rise to the peak: the points from where the rise passes half the
+# peak height above the baseline before it.
+def responseWidth(points, peak):
+    ys = points.ys
+    if peak == 0: return 0
+    baseline = np.median(ys[:max(1,peak//2)])
+    below = np.flatnonzero(ys[:peak] < (ys[peak]+baseline)/2)
+    if len(below) == 0: return peak
+    return peak - below[-1]
+
+# This function picks a fit window between the decay peak and the
+# noise floor, scoring steps x steps candidate windows at once from
+# the running sums of a CumulativeFit. Windows end while the decay is
+# still endLevel noise deviations above the baseline, as the log of
+# noisier points is biased low, and pass with at least minSpan points,
+# a fit r2 of at least minR2 and an rms log residual of at most
+# maxResidual. The instrument response and any scatter at the peak
+# bend the start of the decay, so starts are taken from a response
+# width past the peak, see responseWidth, and the window starts at the
+# first start whose longest passing window has a slope within a
+# fraction tolerance, or agreement standard errors, of those of every
+# later start, and ends where that window does. The tolerance keeps
+# the window the same for longer records of the same decay, whose
+# standard errors are smaller. If none pass, the best fitting window
+# is taken. It returns the window's bounds (s), or None,None if the
+# decay is too short to fit.
+def autoWindow(points, sums=None, steps=64, minSpan=20, minR2=0.99,
+        maxResidual=0.1, agreement=2, tolerance=0.002, endLevel=10):
+    if len(points) < minSpan: return None,None
+    if sums == None: sums = CumulativeFit(points)
+    peak = int(np.argmax(points.ys))
+    floor = noiseFloor(points,peak,level=endLevel)
+    if floor - peak < minSpan: floor = noiseFloor(points,peak)
+    if floor - peak < minSpan: return None,None
+    first = peak + responseWidth(points,peak)
+    if floor - first < 2*minSpan: first = peak
+    # window starts in the first half of the decay past the response,
+    # ends anywhere after them, both on the block edges of the sums
+    block = sums.block
+    lo = np.linspace(first,(first+floor)//2,steps).astype(int)
+    hi = np.linspace(first+minSpan,floor,steps).astype(int)
+    lo,hi = np.unique(-(-lo//block)),np.unique(hi//block)
+    n,S_x,S_y,S_xy,S_xx,S_yy = (sums.sums[:,None,hi] -
+        sums.sums[:,lo,None])
+    with np.errstate(divide="ignore",invalid="ignore"):
+        SS_xy = S_xy - S_x*S_y/n
+        SS_xx = S_xx - S_x*S_x/n
+        SS_yy = S_yy - S_y*S_y/n
+        r2 = SS_xy*SS_xy/(SS_xx*SS_yy)
+        SS_res = np.maximum(SS_yy - SS_xy*SS_xy/SS_xx,0)
+        residual = np.sqrt(SS_res/(n-2))
+        slope = SS_xy/SS_xx
+        error = residual/np.sqrt(SS_xx) # of the slope
+        enough = n >= max(minSpan,3)
+        good = enough & (r2 >= minR2) & (residual <= maxResidual)
+    if not enough.any(): return None,None
+    if not good.any():
+        score = np.where(enough,np.nan_to_num(r2),-np.inf)
+        i,j = np.unravel_index(np.argmax(score),score.shape)
+        return points.time(lo[i]*block),points.time(hi[j]*block-1)
+    # the longest passing window of each start, r2 breaking ties
+    rows = np.flatnonzero(good.any(axis=1))
+    ends = np.argmax(np.where(good,n+np.nan_to_num(r2),-np.inf)[rows],
+        axis=1)
+    slopes,errors = slope[rows,ends],error[rows,ends]
+    # whether each start agrees with each later one - the later window
+    # is nearly within the earlier, so the error of the difference of
+    # their slopes is that of the difference of their variances, but
+    # small differences agree however many points there are
+    with np.errstate(invalid="ignore"):
+        agree = (np.abs(slopes[:,None]-slopes[None,:]) <= np.maximum(
+            tolerance*np.abs(slopes[None,:]),agreement*
+            np.sqrt(np.abs(errors[None,:]**2-errors[:,None]**2))))
+    agree |= np.tri(len(rows),dtype=bool)
+    k = np.argmax(agree.all(axis=1))
+    return (points.time(lo[rows[k]]*block),
+        points.time(hi[ends[k]]*block-1))
+
+# This class holds a copy of the bounds for fitting off the main
+# thread, and collects the fit results from linReg. Without bound,
+# both bounds are taken as set.
+class FitJob(object):
+
+    def __init__(self,lb,ub,bound=None):
+        self.lb = lb
+        self.ub = ub
+        if bound == None: bound = [lb,ub]
+        self.bound = list(bound)
+
+    # This function copies the fit results into data.
+    def results(self,data):
+        data.slope,data.yint = self.slope,self.yint
+        data.r2,data.lifetime = self.r2,self.lifetime
+
+
+####################################
+# batch fitting #
+####################################
+
+# This class holds the fits of many traces, a row per trace. The
+# lifetimes (ns) and amplitudes have a column per exponential term,
+# amplitudes being taken at the start of each trace's fit window.
+class TraceFits(object):
+
+    def __init__(self,wells,terms):
+        self.lifetime = np.full((wells,terms),np.nan)
+        self.amplitude = np.full((wells,terms),np.nan)
+        self.offset = np.zeros(wells)
+        self.r2 = np.full(wells,np.nan)
+        # one standard deviation uncertainties of the parameters
+        self.lifetimeError = np.full((wells,terms),np.nan)
+        self.amplitudeError = np.full((wells,terms),np.nan)
+        self.offsetError = np.zeros(wells)
+        self.points = np.zeros(wells,dtype=int) # points in each fit
+
+# This function fits a (wells x samples) array of traces at once. The
+# sample times are xzero + xincr * (sample index), and xzero, xincr
+# and the bounds lb and ub (s, nan when unset) can be given per well.
+# The model is "loglinear" for a line through the log of the points,
+# weighted by their voltage squared unless weighted is False, or
+# "single" or "double" for a least squares fit of one or two
+# exponentials plus an offset. Traces without enough points to fit
+# get nan fits.
+def fitTraces(traces, xzero, xincr, lb=None, ub=None, model="loglinear",
+        weighted=True, iterations=100):
+    ys = np.atleast_2d(np.asarray(traces,dtype=np.float64))
+    wells,samples = ys.shape
+    if samples == 0: return TraceFits(wells,2 if model == "double" else 1)
+    # sample times in ns, which keeps the fit well scaled
+    column = lambda value: np.reshape(np.asarray(value,dtype=np.float64),
+        (-1,1))
+    ts = (column(xzero) + column(xincr)*np.arange(samples))*10**9
+    ts = np.broadcast_to(ts,ys.shape)
+    inBound = np.isfinite(ys)
+    # unset (nan) bounds leave the points on their side in
+    for (bound,inside,unset) in ((lb,np.greater_equal,-np.inf),
+            (ub,np.less_equal,np.inf)):
+        if bound is None: continue
+        bound = column(bound)*10**9
+        inBound &= inside(ts,np.where(np.isnan(bound),unset,bound))
+    # times from the start of each fit window
+    start = np.where(inBound,ts,np.inf).min(axis=1)
+    start[np.isinf(start)] = 0
+    ts = ts - start[:,None]
+    with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+        if model == "loglinear":
+            return logLinearFits(ts,ys,inBound,weighted)
+        elif model == "single": terms = 1
+        elif model == "double": terms = 2
+        else: raise ValueError("unknown fit model " + str(model))
+        return exponentialFits(ts,ys,inBound,terms,iterations)
+
+# This function fits lines through the log of the points of many
+# traces, using weighted sums over the points in each window.
+def logLinearFits(ts, ys, inBound, weighted):
+    fits = TraceFits(len(ys),1)
+    valid = inBound & (ys > 0)
+    logs = np.log(np.where(valid,ys,1.0))
+    # the log of a point has a variance of about (noise/voltage)^2
+    if weighted: weights = np.where(valid,ys**2,0.0)
+    else: weights = valid.astype(np.float64)
+    total = weights.sum(axis=1)
+    m_x = (weights*ts).sum(axis=1)/total
+    m_y = (weights*logs).sum(axis=1)/total
+    dx,dy = ts-m_x[:,None],logs-m_y[:,None]
+    SS_xx = (weights*dx*dx).sum(axis=1)
+    slope = (weights*dx*dy).sum(axis=1)/SS_xx
+    yint = m_y-slope*m_x
+    SSE = (weights*(dy-slope[:,None]*dx)**2).sum(axis=1)
+    fits.points = n = valid.sum(axis=1)
+    fits.r2 = 1-SSE/(weights*dy*dy).sum(axis=1)
+    # the weights are relative, so the residuals set their scale
+    variance = SSE/(n-2)
+    slopeError = np.sqrt(variance/SS_xx)
+    yintError = np.sqrt(variance*(1/total+m_x**2/SS_xx))
+    fits.lifetime[:,0] = -1/slope
+    fits.lifetimeError[:,0] = slopeError/slope**2
+    fits.amplitude[:,0] = np.exp(yint)
+    fits.amplitudeError[:,0] = fits.amplitude[:,0]*yintError
+    unfit = n < 3
+    fits.lifetime[unfit] = fits.amplitude[unfit] = np.nan
+    return fits
+
+# This function evaluates a sum of exponentials plus an offset, with
+# parameters [amplitude, rate, ..., offset] per trace, and its
+# derivatives with respect to each parameter.
+def exponentialModel(params, ts):
+    terms = (params.shape[1]-1)//2
+    model = np.repeat(params[:,-1:],ts.shape[1],axis=1)
+    gradient = np.empty(ts.shape+params.shape[1:])
+    for term in range(terms):
+        amplitude = params[:,2*term,None]
+        rate = params[:,2*term+1,None]
+        decay = np.exp(-rate*ts)
+        model += amplitude*decay
+        gradient[:,:,2*term] = decay
+        gradient[:,:,2*term+1] = -amplitude*ts*decay
+    gradient[:,:,-1] = 1
+    return model,gradient
+
+# This function fits sums of exponentials plus an offset to many
+# traces at once by Levenberg-Marquardt, each trace taking its own
+# steps, starting from a weighted log-linear fit.
+def exponentialFits(ts, ys, inBound, terms, iterations):
+    wells,count = len(ys),2*terms+1
+    fits = TraceFits(wells,terms)
+    fits.points = n = inBound.sum(axis=1)
+    # starting point from a line through the log of the points
+    guess = logLinearFits(ts,ys,inBound,True)
+    span = np.where(inBound,ts,0).max(axis=1)
+    rate = 1/guess.lifetime[:,0]
+    bad = ~np.isfinite(rate) | (rate <= 0)
+    rate[bad] = 3/np.maximum(span[bad],1e-9)
+    amplitude = guess.amplitude[:,0]
+    amplitude[~np.isfinite(amplitude)] = np.abs(ys).max(axis=1)[
+        ~np.isfinite(amplitude)]
+    params = np.zeros((wells,count))
+    for term in range(terms):
+        # spreads the starting rates around the single rate
+        params[:,2*term] = amplitude/terms
+        params[:,2*term+1] = rate*2.0**(terms-1-2*term)
+    ys = np.where(inBound,ys,0)
+    # This function finds the sum of squared residuals of each trace.
+    def residuals(params):
+        model,gradient = exponentialModel(params,ts)
+        return np.where(inBound,ys-model,0),gradient
+    residual,gradient = residuals(params)
+    cost = (residual**2).sum(axis=1)
+    damping = np.full(wells,1e-3)
+    diagonal = np.arange(count)
+    # traces with enough points to fit, which aren't flat
+    active = ((n > count) & (np.where(inBound,ys,-np.inf).max(axis=1) >
+        np.where(inBound,ys,np.inf).min(axis=1)))
+    for iteration in range(iterations):
+        gradient *= inBound[:,:,None]
+        JTJ = np.einsum("wnp,wnq->wpq",gradient,gradient)
+        JTr = np.einsum("wnp,wn->wp",gradient,residual)
+        scale = JTJ[:,diagonal,diagonal]
+        system = JTJ.copy()
+        system[:,diagonal,diagonal] += (damping[:,None]*scale +
+            1e-12*scale.max(axis=1)[:,None] + 1e-300)
+        system[~active] = np.eye(count)
+        step = np.linalg.solve(system,JTr[:,:,None])[:,:,0]
+        trial = params+step
+        trialResidual,trialGradient = residuals(trial)
+        trialCost = (trialResidual**2).sum(axis=1)
+        better = (active & (trialCost < cost) &
+            (trial[:,1:-1:2] > 0).all(axis=1))
+        params[better] = trial[better]
+        cost[better] = trialCost[better]
+        residual[better] = trialResidual[better]
+        gradient[better] = trialGradient[better]
+        damping = np.where(better,damping/3,damping*4)
+        # stops once no trace can improve by a meaningful step
+        small = np.abs(step) <= 1e-10*(np.abs(params)+1e-10)
+        if not (active & ~small.all(axis=1) & (damping < 1e12)).any():
+            break
+    # parameter covariance from the residuals about the fit
+    gradient *= inBound[:,:,None]
+    JTJ = np.einsum("wnp,wnq->wpq",gradient,gradient)
+    JTJ[~active] = np.eye(count)
+    variance = np.linalg.pinv(JTJ)*(cost/(n-count))[:,None,None]
+    errors = np.sqrt(np.abs(variance[:,diagonal,diagonal]))
+    mean = np.where(inBound,ys,0).sum(axis=1)/n
+    fits.r2 = 1-cost/(np.where(inBound,ys-mean[:,None],0)**2).sum(axis=1)
+    rates = params[:,1:-1:2]
+    fits.lifetime = 1/rates
+    fits.lifetimeError = errors[:,1:-1:2]/rates**2
+    fits.amplitude = params[:,0:-1:2]
+    fits.amplitudeError = errors[:,0:-1:2]
+    fits.offset = params[:,-1]
+    fits.offsetError = errors[:,-1]
+    # orders the terms from the shortest lifetime
+    order = (np.arange(wells)[:,None],np.argsort(fits.lifetime,axis=1))
+    for name in ("lifetime","lifetimeError","amplitude","amplitudeError"):
+        values = getattr(fits,name)[order]
+        values[~active] = np.nan
+        setattr(fits,name,values)
+    fits.r2[~active] = fits.offset[~active] = np.nan
+    return fits
+
+
+####################################
+# saving #
+####################################
+
+# This function creates a 96 well grid of white space 
+# iteratively to avoid aliasing.
+def initGrid():
+    grid = []
+    for j in range(8):
+        row = []
+        for i in range(12):
+            row.append("white")
+        grid.append(row)
+    return grid
+
+# This function names the file of a well from the grid labels.
+def wellName(data, row, col):
+    letters = ["A","B","C","D","E","F","G","H"]
+    return (letters[row] + "%02d-" + data.header[0] + 
+        data.rowName[row] + data.header[1] + data.colName[col]) % (col+1)
+
+# This function saves a fit and the points it was made from to a
+# txt file.
+def saveFit(fileName, fit, points, logPoints):
+    # the log points keep the sample indices of the points they
+    # came from, which line them up with their linear voltages
+    columns = np.column_stack((logPoints.xs(),
+        points.at(logPoints.indices()),logPoints.ys))
+    # comma-separates all data for processing by mathematica
+    header = str(fit.lifetime) + ",\n" + str(fit.r2) + ","
+    np.savetxt(fileName,columns,fmt="%.12g",delimiter=",",
+        header=header,comments="")
+
+# This function saves a well in each of the given formats - "txt" for
+# the text file, "npz" for a numpy file of its own and "archive" to
+# add it to the plate archive of the folder.
+def saveWell(foldName, name, row, col, fit, points, logPoints,
+        formats=SAVE_FORMATS):
+    start = STATS.start()
+    if "txt" in formats:
+        saveFit(foldName + "/" + name + ".txt",fit,points,logPoints)
+    if "npz" in formats:
+        header = wellHeader(row,col,name,fit,points)[0]
+        fields = dict((field,header[field]) for field in WELL_FIELDS)
+        np.savez(foldName + "/" + name + ".npz",ys=points.ys,
+            index=points.indices(),logIndex=logPoints.indices(),**fields)
+    if "archive" in formats:
+        appendWell(foldName + "/" + ARCHIVE_NAME,row,col,name,fit,points)
+    STATS.stop("save",start)
+
+# This function checks whether a well has been saved in any format.
+def isSaved(foldName, name, archive=None):
+    if (os.path.exists(foldName + "/" + name + ".txt") or
+            os.path.exists(foldName + "/" + name + ".npz")):
+        return True
+    return archive != None and name in archive.names
+
+
+####################################
+# binary results #
+####################################
+
+# A plate archive is a single file that wells are appended to, each
+# as a fixed size header followed by its voltages as float32 and, for
+# traces with dropped points, their int32 sample indices. It can be
+# memory mapped to read one well or all of them without parsing text.
+# A well saved again replaces the earlier copy when read.
+ARCHIVE_NAME = "plate.wells"
+WELL_HEADER = np.dtype([("magic","S4"),("row","<i2"),("col","<i2"),
+    ("name","S64"),("lifetime","<f8"),("r2","<f8"),("slope","<f8"),
+    ("yint","<f8"),("lb","<f8"),("ub","<f8"),("preamble","<f8",(5,)),
+    ("xzero","<f8"),("xincr","<f8"),("count","<i8"),("indexed","<i8")])
+# the header fields saved with the fit
+WELL_FIELDS = ["row","col","name","lifetime","r2","slope","yint","lb",
+    "ub","preamble","xzero","xincr"]
+
+# This function makes the header of a well, with unset bounds and
+# preamble values as nan.
+def wellHeader(row, col, name, fit, points):
+    header = np.zeros(1,dtype=WELL_HEADER)
+    header["magic"] = b"WELL"
+    header["row"],header["col"],header["name"] = row,col,name
+    header["lifetime"],header["r2"] = fit.lifetime,fit.r2
+    header["slope"],header["yint"] = fit.slope,fit.yint
+    header["lb"] = fit.lb if fit.bound[0] != None else np.nan
+    header["ub"] = fit.ub if fit.bound[1] != None else np.nan
+    header["preamble"] = points.preamble if points.preamble else np.nan
+    header["xzero"],header["xincr"] = points.xzero,points.xincr
+    header["count"] = len(points)
+    header["indexed"] = points.index is not None
+    return header
+
+# This function appends a well to a plate archive.
+def appendWell(fileName, row, col, name, fit, points):
+    with open(fileName,"ab") as f:
+        f.write(wellHeader(row,col,name,fit,points).tobytes())
+        f.write(points.ys.astype("<f4").tobytes())
+        if points.index is not None:
+            f.write(points.index.astype("<i4").tobytes())
+
+# This class reads a plate archive through a memory map, so only the
+# wells asked for are read from disk.
+class PlateArchive(object):
+
+    def __init__(self,fileName):
+        self.offsets = {} # (row,col) -> offset of its latest copy
+        self.names = set() # names of the wells in the archive
+        self.data = np.zeros(0,dtype=np.uint8)
+        if os.path.getsize(fileName) > 0:
+            self.data = np.memmap(fileName,dtype=np.uint8,mode="r")
+        offset = 0
+        while offset + WELL_HEADER.itemsize <= len(self.data):
+            header = self.header(offset)
+            if header["magic"] != b"WELL":
+                raise ValueError("bad well header in plate archive")
+            end = (offset + WELL_HEADER.itemsize +
+                4*header["count"]*(1+header["indexed"]))
+            if end > len(self.data): break # an unfinished last well
+            self.offsets[(int(header["row"]),int(header["col"]))] = offset
+            self.names.add(header["name"].decode())
+            offset = end
+
+    # This function reads the header at an offset in the archive.
+    def header(self,offset):
+        raw = self.data[offset:offset+WELL_HEADER.itemsize]
+        return np.frombuffer(raw.tobytes(),dtype=WELL_HEADER)[0]
+
+    # This function lists the wells in the archive, in save order.
+    def wells(self):
+        return sorted(self.offsets)
+
+    # This function gives the header and the points of a well. The
+    # voltages are read from the archive as they are used.
+    def well(self,row,col):
+        offset = self.offsets[(row,col)]
+        header = self.header(offset)
+        start = offset + WELL_HEADER.itemsize
+        count = int(header["count"])
+        ys = self.data[start:start+4*count].view("<f4")
+        index = None
+        if header["indexed"]:
+            start += 4*count
+            index = self.data[start:start+4*count].view("<i4")
+        preamble = None
+        if not np.isnan(header["preamble"]).any():
+            preamble = header["preamble"].tolist()
+        return header,Waveform(ys,float(header["xzero"]),
+            float(header["xincr"]),preamble,index)
+
+    # This function gives the headers of all wells as one array, and
+    # their voltages as a (wells x samples) array, with nan for the
+    # samples a well doesn't have.
+    def traces(self):
+        wells = [self.well(row,col) for (row,col) in self.wells()]
+        headers = np.array([header for (header,points) in wells],
+            dtype=WELL_HEADER)
+        samples = max([points.indices()[-1]+1 for (header,points) in wells
+            if len(points) > 0] + [0])
+        traces = np.full((len(wells),samples),np.nan,dtype=np.float32)
+        for i in range(len(wells)):
+            points = wells[i][1]
+            traces[i,points.indices()] = points.ys
+        return headers,traces
+
+# This function refits every well of a plate archive in one call, with
+# the bounds each well was saved with unless lb or ub are given.
+def fitArchive(archive, model="loglinear", lb=None, ub=None):
+    headers,traces = archive.traces()
+    if lb == None: lb = headers["lb"]
+    if ub == None: ub = headers["ub"]
+    return headers,fitTraces(traces,headers["xzero"],headers["xincr"],lb,ub,
+        model)
+
+
+####################################
+# plate scan #
+####################################
+
+# This class holds the grid labels and progress of a 96 well plate,
+# as the save screen does, for scanning without the UI.
+class Plate(object):
+
+    def __init__(self,foldName):
+        self.foldName = foldName # folder the well files go in
+        self.color = initGrid() # green once a well is saved
+        self.colName = map(str,range(1,13))
+        self.rowName = map(str,range(1,9))
+        self.header = ["NN","CN"]
+        self.last = (None,None) # last well saved
+
+# This class adds up the time spent in each stage of a scan.
+class StageTimes(object):
+
+    def __init__(self):
+        self.total = {} # seconds spent, by stage
+        self.count = {} # wells done, by stage
+        self.start = time.time()
+
+    # This function records a well going through a stage.
+    def add(self,stage,seconds):
+        self.total[stage] = self.total.get(stage,0) + seconds
+        self.count[stage] = self.count.get(stage,0) + 1
+
+    # This function describes the throughput of each stage.
+    def report(self):
+        lines = []
+        for stage in sorted(self.total):
+            perWell = self.total[stage]/self.count[stage]
+            lines.append("%s: %d wells, %.1f ms/well, %.2f wells/s" % (stage,
+                self.count[stage],perWell*1000,1/perWell if perWell else 0))
+        lines.append("plate: %.1f s" % (time.time()-self.start))
+        return "\n".join(lines)
+
+# This function lists the wells of a plate still to be scanned, in
+# save order, marking those already saved in the folder as collected
+# so an interrupted scan resumes where it stopped.
+def plateWells(plate):
+    archive = None
+    if os.path.exists(plate.foldName + "/" + ARCHIVE_NAME):
+        archive = PlateArchive(plate.foldName + "/" + ARCHIVE_NAME)
+    wells = []
+    for row in range(8):
+        for col in range(12):
+            if isSaved(plate.foldName,wellName(plate,row,col),archive):
+                plate.color[row][col] = "green"
+            else: wells.append((row,col))
+    return wells
+
+# This function scans the wells of a plate, saving a fit for each.
+# Acquisition runs a well ahead on a worker thread, so that the scope
+# transfer of one well overlaps the fit and save of the last. ready
+# is called with each well before it is acquired, e.g. to wait for
+# it to be moved into place. With auto, each well is fit over the
+# window autoWindow picks for it instead of the bounds in fit. Each
+# well is averaged over shots acquisitions, frames at a time, see
+# getAverage. With windowed, only the samples of the bounds in fit and
+# a margin around them are transferred, see sampleWindow, or the whole
+# record if a bound isn't set.
+def scanPlate(scope, plate, fit, wells=None, ready=None, progress=None,
+        formats=SAVE_FORMATS, auto=False, shots=1, snr=None, frames=1,
+        source=SOURCE, length=RECORD_LENGTH, windowed=False, margin=0.1):
+    if wells == None: wells = plateWells(plate)
+    if progress == None: progress = Progress()
+    times = StageTimes()
+    first,count = 1,length
+    if windowed and not auto and None not in (fit.lb,fit.ub):
+        first,count = sampleWindow(scope,fit.lb,fit.ub,margin,source,length)
+    acquired = Queue.Queue(maxsize=1)
+    # acquires the wells in order, ending with None or the error
+    # that stopped it
+    def acquire():
+        try:
+            for (row,col) in wells:
+                if ready != None: ready(row,col)
+                start = time.time()
+                points,xlim,ylim = getAverage(scope,shots,snr,
+                    progress=progress,frames=frames,source=source,
+                    length=count,first=first)
+                times.add("acquire",time.time()-start)
+                acquired.put((row,col,points))
+            acquired.put(None)
+        except Exception as error:
+            acquired.put(error)
+    thread = threading.Thread(target=acquire)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            well = acquired.get()
+            if well == None: break
+            elif isinstance(well,Exception): raise well
+            row,col,points = well
+            start = time.time()
+            if auto:
+                fit.lb,fit.ub = autoWindow(points)
+                fit.bound = [fit.lb,fit.ub]
+            logPoints = logData(points,fit)
+            linReg(fit,logPoints)
+            times.add("fit",time.time()-start)
+            start = time.time()
+            saveWell(plate.foldName,wellName(plate,row,col),row,col,fit,
+                points,logPoints,formats)
+            times.add("save",time.time()-start)
+            plate.color[row][col] = "green"
+            plate.last = (row,col)
+            STATS.record(well=wellName(plate,row,col),
+                lifetime=fit.lifetime,r2=fit.r2)
+    finally:
+        # stops the acquisition if the scan ends early
+        progress.cancel()
+    return times
+
+
+####################################
+# command line #
+####################################
+
+# This function reads the x,y columns of a trace or well txt file back
+# into a Waveform, skipping the lifetime and r2 lines and any points
+# without a voltage.
+def readTrace(fileName):
+    xs,ys = [],[]
+    with open(fileName, "rt") as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) < 2 or fields[1] in ("","None"): continue
+            xs.append(float(fields[0]))
+            ys.append(float(fields[1]))
+    xs,ys = np.array(xs),np.array(ys)
+    xincr = np.diff(xs).min() if len(xs) > 1 else 1.0
+    index = np.round((xs-xs[0])/xincr).astype(int)
+    return Waveform(ys,xs[0],xincr,None,index)
+
+# This function saves the x,y points of a trace to a txt file.
+def saveTrace(fileName, points):
+    np.savetxt(fileName,np.column_stack((points.xs(),points.ys)),
+        fmt="%r",delimiter=",")
+
+# This function saves aligned channels to a txt file, a column of
+# times then a column per channel, the first read back by readTrace.
+def saveChannels(fileName, ys, xzero, xincr):
+    xs = xzero + xincr*np.arange(ys.shape[1])
+    np.savetxt(fileName,np.column_stack([xs] + list(ys)),fmt="%r",
+        delimiter=",")
+
+# This function runs a command from the shell, for batch jobs:
+# > python osccore.py acquire <file> [--shots <n>] [--snr <ratio>]
+# > python osccore.py --points 100000 acquire <file> --channels CH1,CH2
+# > python osccore.py fit <file> --lb <s> --ub <s> [--save <file>]
+# > python osccore.py scan-plate <folder> --lb <s> --ub <s> [--prompt]
+# > python osccore.py scan-plate <folder> --auto
+# > python osccore.py scan-plate <folder> --lb <s> --ub <s> --windowed
+# > python osccore.py refit <folder> [--model single]
+# > python osccore.py frames <count> [--lb <s>] [--ub <s>]
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Fluorescence lifetime measurements.")
+    parser.add_argument("--ip",default=SCOPE_IP,
+        help="instrument ip address")
+    parser.add_argument("--source",default=SOURCE,
+        help="channel to acquire")
+    parser.add_argument("--points",type=int,default=RECORD_LENGTH,
+        help="points in each record")
+    commands = parser.add_subparsers(dest="command")
+    acquire = commands.add_parser("acquire",
+        help="save a new trace to a txt file")
+    acquire.add_argument("file")
+    acquire.add_argument("--channels",
+        help="comma-separated channels to save from one shot instead")
+    fit = commands.add_parser("fit",
+        help="fit a trace or well txt file")
+    fit.add_argument("file")
+    fit.add_argument("--save",help="well txt file to save the fit to")
+    scan = commands.add_parser("scan-plate",
+        help="scan the 96 wells of a plate into a folder")
+    scan.add_argument("folder")
+    scan.add_argument("--prompt",action="store_true",
+        help="wait for enter before each well")
+    scan.add_argument("--formats",default=",".join(SAVE_FORMATS),
+        help="formats to save wells in: txt, npz, archive")
+    scan.add_argument("--windowed",action="store_true",
+        help="transfer only the samples around the bounds")
+    scan.add_argument("--margin",type=float,default=0.1,
+        help="samples to transfer each side of the bounds, as a "
+        "fraction of the window")
+    refit = commands.add_parser("refit",
+        help="fit every well of a folder's plate archive at once")
+    refit.add_argument("folder")
+    refit.add_argument("--model",default="loglinear",
+        choices=["loglinear","single","double"])
+    frames = commands.add_parser("frames",
+        help="fit each of many FastFrame shots, giving their spread")
+    frames.add_argument("count",type=int)
+    frames.add_argument("--model",default="loglinear",
+        choices=["loglinear","single","double"])
+    for command in (fit,scan,refit,frames):
+        command.add_argument("--lb",type=float,help="lower bound (s)")
+        command.add_argument("--ub",type=float,help="upper bound (s)")
+    for command in (fit,scan):
+        command.add_argument("--auto",action="store_true",
+            help="pick the fit window of each trace instead")
+    for command in (acquire,scan):
+        command.add_argument("--shots",type=int,default=1,
+            help="acquisitions to average")
+        command.add_argument("--snr",type=float,
+            help="signal to noise ratio to stop averaging at")
+        command.add_argument("--frames",type=int,default=1,
+            help="shots to take per transfer, with FastFrame")
+    args = parser.parse_args(args)
+    if args.command == "acquire":
+        if args.channels:
+            ys,xzero,xincr,limits = getChannels(Scope(args.ip),
+                args.channels.split(","),length=args.points)
+            saveChannels(args.file,ys,xzero,xincr)
+        else:
+            points,xlim,ylim = getAverage(Scope(args.ip),args.shots,
+                args.snr,frames=args.frames,source=args.source,
+                length=args.points)
+            saveTrace(args.file,points)
+    elif args.command == "fit":
+        points = readTrace(args.file)
+        if args.auto: args.lb,args.ub = autoWindow(points)
+        fit = FitJob(args.lb,args.ub,[args.lb,args.ub])
+        logPoints = logData(points,fit)
+        linReg(fit,logPoints)
+        print("lifetime (ns): %8.4f" % fit.lifetime)
+        print("r^2: %8f" % fit.r2)
+        if args.save: saveFit(args.save,fit,points,logPoints)
+    elif args.command == "scan-plate":
+        if args.windowed and None in (args.lb,args.ub):
+            parser.error("--windowed needs --lb and --ub")
+        plate = Plate(args.folder)
+        ready = None
+        if args.prompt:
+            ready = lambda row,col: raw_input("Place well %s, then press "
+                "enter" % wellName(plate,row,col))
+        fit = FitJob(args.lb,args.ub,[args.lb,args.ub])
+        print(scanPlate(Scope(args.ip),plate,fit,ready=ready,
+            formats=args.formats.split(","),auto=args.auto,
+            shots=args.shots,snr=args.snr,frames=args.frames,
+            source=args.source,length=args.points,windowed=args.windowed,
+            margin=args.margin).report())
+    elif args.command == "refit":
+        archive = PlateArchive(args.folder + "/" + ARCHIVE_NAME)
+        headers,fits = fitArchive(archive,args.model,args.lb,args.ub)
+        # one comma-separated line per well
+        for i in range(len(headers)):
+            values = (fits.lifetime[i].tolist() +
+                fits.lifetimeError[i].tolist() + [fits.r2[i]])
+            print(",".join([headers["name"][i].decode()] + map(str,values)))
+    elif args.command == "frames":
+        ys,xzero,xincr,limits = getFrames(Scope(args.ip),args.count,
+            source=args.source,length=args.points)
+        fits,mean,deviation,error = frameLifetimes(ys,xzero,xincr,args.lb,
+            args.ub,args.model)
+        print("frames: %d" % len(ys))
+        print("lifetime (ns): %8.4f +- %.4f (sd %.4f)" % (mean,error,
+            deviation))
+        average = Average()
+        average.addFrames(ys,xzero,xincr,limits)
+        fits = fitTraces(average.mean,xzero,xincr,args.lb,args.ub,args.model)
+        print("lifetime of average (ns): %8.4f" % fits.lifetime[0,0])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,346 @@
+# sim.py
+
+
+# This file simulates the oscilloscope, so that acquisition can be run
+# and timed without one. It answers the commands osccore.py sends
+# (:DATA:*, :WFMPRE:*?, CURVE?, *WAI, and the :HORIZONTAL:FASTFRAME
+# and :ACQUIRE commands with *OPC?) in ASCII and binary encodings. Each
+# channel has a decay, but CH2, which has the laser pulse as a
+# reference, and the link is as slow and unreliable as it is set to
+# be. It can be used in place of a vxi11 instrument:
+# > scope = Scope(link=Simulator(bandwidth=1e6).connect)
+# served on a raw socket, for any program:
+# > python sim.py serve --port 4000 --latency 0.002
+# > python osccore.py --ip TCPIP::127.0.0.1::4000::SOCKET acquire t.txt
+# or used to time acquisitions through the reconnects of a bad link:
+# > python sim.py soak --transfers 200 --drop 0.05
+
+
+import numpy as np
+import sys
+import time
+import random
+import threading
+from osccore import *
+
+
+################################
+######### SIMULATOR ############
+################################
+
+# This class holds the simulated scope: its record, and the link it is
+# reached over. Bandwidth is in bytes/s (None for no limit), latency
+# and jitter in seconds per command, and drop is the chance of the
+# link dropping partway through a curve transfer. While running, the
+# scope triggers rate times a second, queries between triggers getting
+# the same shot, or a new shot each query if rate is None.
+class Simulator(object):
+
+    def __init__(self,samples=10000,lifetime=2e-6,noise=0.002,
+            xincr=1e-9,bandwidth=None,latency=0,jitter=0,drop=0,seed=None,
+            rate=None):
+        self.samples = samples # points in the record
+        self.lifetime = lifetime # decay lifetime (s)
+        self.noise = noise # noise deviation (V)
+        self.xincr = xincr # time between samples (s)
+        self.ymult = 2/30000.0 # volts per curve value
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.seed = seed
+        self.rate = rate
+        self.random = random.Random(seed) # for the link
+        self.noisy = np.random.RandomState(seed) # for the shots
+        self.lock = threading.Lock()
+        self.curves = {} # channel -> decay without noise (V)
+        self.triggered = {} # channel -> time and shot of the last trigger
+        # counts, for reports
+        self.connections = 0
+        self.messages = 0 # writes to the links
+        self.reads = 0
+        self.commands = 0
+        self.sent = 0 # bytes
+        self.drops = 0
+
+    # This function opens a new link to the simulator, taking the ip
+    # so that it can be a Scope's link.
+    def connect(self,ip=None):
+        with self.lock: self.connections += 1
+        return SimLink(self)
+
+    # This function gives the curve values of count new shots of a
+    # channel, a (count x samples) array. Each shot is a decay peaking
+    # a tenth of the way into the record, with noise of its own, but
+    # on the reference channel CH2 it is the laser pulse exciting it.
+    def shots(self,source,count=1):
+        with self.lock:
+            if source not in self.curves:
+                ts = np.arange(self.samples)*self.xincr
+                ts -= self.samples*self.xincr/10
+                if source == "CH2": self.curves[source] = np.exp(
+                    -0.5*(ts/(5*self.xincr))**2)
+                else: self.curves[source] = np.where(ts < 0,0,
+                    np.exp(-ts/self.lifetime))
+            noise = self.noisy.normal(0,self.noise,(count,self.samples))
+        ys = self.curves[source] + noise
+        return np.clip(np.round(ys/self.ymult),-32768,32767).astype(np.int16)
+
+    # This function gives the shot of a channel from the last trigger
+    # of the running scope.
+    def running(self,source):
+        now = time.time()
+        with self.lock: last = self.triggered.get(source)
+        if self.rate == None or last == None or now-last[0] >= 1.0/self.rate:
+            last = (now,self.shots(source))
+            with self.lock: self.triggered[source] = last
+        return last[1]
+
+    # This function waits out the delay of a command on the link.
+    def delay(self):
+        wait = self.latency + self.random.uniform(0,self.jitter)
+        if wait > 0: time.sleep(wait)
+
+    # This function waits out the transfer of count bytes.
+    def transfer(self,count):
+        with self.lock: self.sent += count
+        if self.bandwidth != None: time.sleep(count/float(self.bandwidth))
+
+    # This function describes what the simulator has done.
+    def report(self):
+        return ("%d connections, %d messages, %d reads, %d commands, "
+            "%.1f MB sent, %d drops" % (self.connections,self.messages,
+            self.reads,self.commands,self.sent/1e6,self.drops))
+
+# This class is one link to the simulator, with the calls of a vxi11
+# instrument. Like the scope, it keeps its data setup until it is
+# changed, and queues the replies to a message for reading.
+class SimLink(object):
+
+    def __init__(self,sim):
+        self.sim = sim
+        self.setup = {"SOURCE":"CH1","START":1,"STOP":sim.samples,
+            "ENCDG":"RIBINARY","WIDTH":1,"FRAMESTART":1,"FRAMESTOP":1}
+        self.fastFrame = False # whether shots go to segmented memory
+        self.single = False # whether one sequence is captured and kept
+        self.frames = 1 # shots in a FastFrame sequence
+        self.captured = {} # channel -> shots of the last sequence
+        self.out = b"" # reply waiting to be read
+        self.cut = None # reply bytes sent before the link drops
+        self.closed = False
+
+    # This function runs the commands of a message, queueing the
+    # replies to its queries as one line.
+    def write(self,message):
+        self.check()
+        self.sim.delay()
+        with self.sim.lock: self.sim.messages += 1
+        replies = []
+        self.cut = None
+        for command in message.strip().split(";"):
+            command = command.strip().upper()
+            if command == "": continue
+            with self.sim.lock: self.sim.commands += 1
+            reply = self.run(command)
+            if reply != None: replies.append(reply)
+        if replies != []: self.out = b";".join(replies) + b"\n"
+
+    # This function runs a single command, returning its reply if it
+    # is a query.
+    def run(self,command):
+        if command.startswith(":DATA:"):
+            key,value = (command[6:].split(" ",1) + [""])[:2]
+            if key in ("START","STOP","WIDTH","FRAMESTART","FRAMESTOP"):
+                value = int(value)
+            self.setup[key] = value
+        elif command.startswith(":HORIZONTAL:FASTFRAME:COUNT "):
+            self.frames = int(command.split(" ")[1])
+        elif command.startswith(":HORIZONTAL:FASTFRAME:STATE "):
+            self.fastFrame = command.split(" ")[1] in ("ON","1")
+        elif command.startswith(":ACQUIRE:STOPAFTER "):
+            self.single = command.split(" ")[1] == "SEQUENCE"
+        elif command == ":ACQUIRE:STATE ON":
+            self.captured = {} # a new sequence
+        elif command == "*OPC?": return b"1"
+        elif command.startswith(":WFMPRE:") and command.endswith("?"):
+            return self.preamble(command[8:-1])
+        elif command == "CURVE?":
+            # picks where a dropped link cuts the transfer
+            reply = self.curve()
+            if self.sim.random.random() < self.sim.drop:
+                self.cut = self.sim.random.randrange(len(reply))
+            return reply
+        elif command == "*IDN?": return b"SIMULATED,OSC,0,0"
+        return None
+
+    # This function gives the curve value offset and volts per value
+    # of the set encoding. Unsigned encodings are offset by half their
+    # range, and single bytes keep the top byte of the values.
+    def scale(self):
+        width = self.setup["WIDTH"]
+        offset = 0
+        if self.setup["ENCDG"] == "RPBINARY": offset = 2**(8*width-1)
+        return offset,self.sim.ymult*256**(2-width)
+
+    # This function answers a waveform preamble query.
+    def preamble(self,field):
+        offset,ymult = self.scale()
+        start = self.setup["START"]
+        values = {"YOFF":offset,"YMULT":ymult,"YZERO":0.0,
+            "XINCR":self.sim.xincr,"XZERO":
+            (start-1-self.sim.samples/10.0)*self.sim.xincr}
+        return b"%.6E" % values[field]
+
+    # This function gives the curve data from START to STOP in the
+    # set encoding: a new shot while running, or the shot of the
+    # captured sequence, or with FastFrame, its frames from FRAMESTART
+    # to FRAMESTOP.
+    def curve(self):
+        start = max(1,self.setup["START"])
+        stop = min(self.sim.samples,self.setup["STOP"])
+        source = self.setup["SOURCE"]
+        if not self.single: values = self.sim.running(source)
+        else:
+            frames = self.frames if self.fastFrame else 1
+            if source not in self.captured:
+                self.captured[source] = self.sim.shots(source,frames)
+            values = self.captured[source]
+            if self.fastFrame: values = values[max(1,
+                self.setup["FRAMESTART"])-1:self.setup["FRAMESTOP"]]
+        values = values[:,start-1:stop].ravel()
+        encoding,width = self.setup["ENCDG"],self.setup["WIDTH"]
+        offset,ymult = self.scale()
+        values = values.astype(np.int32)//256**(2-width) + offset
+        if encoding == "ASCII":
+            return ",".join(values.astype(str)).encode()
+        payload = values.astype(BINARY_TYPES[(encoding,width)]).tobytes()
+        length = str(len(payload)).encode()
+        return b"#" + str(len(length)).encode() + length + payload
+
+    # This function raises the error of a dropped link.
+    def check(self):
+        if self.closed: raise IOError("simulated link is closed")
+
+    def read_raw(self,num=-1):
+        self.check()
+        with self.sim.lock: self.sim.reads += 1
+        if num < 0: num = len(self.out)
+        if self.cut != None and self.cut < num:
+            # the link drops partway through the reply
+            self.sim.transfer(self.cut)
+            self.closed = True
+            with self.sim.lock: self.sim.drops += 1
+            raise IOError("simulated link dropped")
+        if self.cut != None: self.cut -= num
+        raw,self.out = self.out[:num],self.out[num:]
+        self.sim.transfer(len(raw))
+        return raw
+
+    def read(self,num=-1):
+        return self.read_raw(num).decode().rstrip("\r\n")
+
+    def clear(self):
+        self.check()
+        self.out = b""
+        self.cut = None
+
+    def close(self):
+        self.closed = True
+
+
+################################
+######### SOCKET SERVER ########
+################################
+
+# This function serves the simulator on a raw socket, as the scope's
+# socket server does, each connection getting its own link. Dropped
+# links close the connection.
+def serve(sim, host="127.0.0.1", port=4000):
+    import SocketServer
+    class Handler(SocketServer.StreamRequestHandler):
+        disable_nagle_algorithm = True # replies go out without waiting
+        def handle(self):
+            link = sim.connect()
+            try:
+                while True:
+                    line = self.rfile.readline()
+                    if line == b"": break
+                    link.write(line.decode())
+                    while link.out != b"":
+                        self.wfile.write(link.read_raw(65536))
+                    self.wfile.flush()
+            except IOError: pass
+    SocketServer.ThreadingTCPServer.allow_reuse_address = True
+    server = SocketServer.ThreadingTCPServer((host,port),Handler)
+    server.daemon_threads = True
+    return server
+
+
+################################
+######### COMMAND LINE #########
+################################
+
+# This function acquires transfers curves through a Scope, printing
+# the rate they came at and what the simulator saw.
+def soak(sim, transfers, encoding, ip=None):
+    link = sim.connect if ip == None else openInstrument
+    scope = Scope(ip or "sim",retries=5,link=link)
+    start = time.time()
+    failed = 0
+    try:
+        for i in range(transfers):
+            try: getData(scope,encoding)
+            except linkErrors(): failed += 1
+    finally: scope.close()
+    seconds = time.time()-start
+    print("%d transfers, %d failed, %.2f transfers/s, %.2f MB/s, "
+        "%.1f round trips/transfer" % (transfers,failed,transfers/seconds,
+        sim.sent/1e6/seconds,(sim.messages+sim.reads)/float(transfers)))
+    print(sim.report())
+
+# This function runs the simulator from the shell.
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Simulated oscilloscope.")
+    parser.add_argument("command",choices=["serve","soak"])
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=4000)
+    parser.add_argument("--samples",type=int,default=10000)
+    parser.add_argument("--bandwidth",type=float,help="link bytes/s")
+    parser.add_argument("--latency",type=float,default=0,
+        help="link delay per message (s)")
+    parser.add_argument("--jitter",type=float,default=0,
+        help="most extra delay per message (s)")
+    parser.add_argument("--drop",type=float,default=0,
+        help="chance of a curve transfer dropping the link")
+    parser.add_argument("--seed",type=int)
+    parser.add_argument("--transfers",type=int,default=100,
+        help="curves to acquire in a soak")
+    parser.add_argument("--encoding",default="RIBINARY",
+        choices=["ASCII","RIBINARY","RPBINARY"])
+    parser.add_argument("--socket",action="store_true",
+        help="soak through the socket server")
+    args = parser.parse_args(args)
+    sim = Simulator(args.samples,bandwidth=args.bandwidth,
+        latency=args.latency,jitter=args.jitter,drop=args.drop,
+        seed=args.seed)
+    if args.command == "serve":
+        server = serve(sim,args.host,args.port)
+        print("serving on TCPIP::%s::%d::SOCKET" % (args.host,args.port))
+        try: server.serve_forever()
+        except KeyboardInterrupt: print(sim.report())
+    elif args.command == "soak":
+        ip = None
+        if args.socket:
+            server = serve(sim,args.host,args.port)
+            # lets the connection end once soak closes its link
+            server.daemon_threads = False
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            ip = "TCPIP::%s::%d::SOCKET" % (args.host,args.port)
+        soak(sim,args.transfers,args.encoding,ip)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])